@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8; py-indent-offset: 4 -*-
+
+# SPDX-FileCopyrightText: © 2023 PL Automation Monitoring GmbH <pl@automation-monitoring.com>
+# SPDX-License-Identifier: GPL-3.0-or-later
+# This file is part of the Checkmk Labelpicker project (https://labelpicker.mk)
+
+"""Offline benchmark of a labelpicker run
+
+Generates synthetic inventory trees, CSV files and a vSphere tag catalogue,
+serves Checkmk and vSphere from local stand-ins and reports wall time,
+REST requests and peak memory of each phase.
+
+Example:
+    ./benchmarks/bench_labelpicker.py --hosts 1000 10000 100000 --json bench.json
+"""
+
+import argparse
+import importlib.util
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import redirect_stdout
+from importlib.machinery import SourceFileLoader
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, os.path.join(REPO_DIR, "lib", "python3"))
+sys.path.insert(0, BENCH_DIR)
+
+import labelpicker.labelpicker_base as lpb  # noqa: E402
+from labelpicker.ds_plugins.lpds_csv import lpds_csv  # noqa: E402
+from labelpicker.ds_plugins.lpds_hwswtree import lpds_hwswtree  # noqa: E402
+from labelpicker.ds_plugins.lpds_vsphere import lpds_vsphere  # noqa: E402
+
+import synthetic  # noqa: E402
+from fake_rest import FakeCheckmk, FakeVSphere  # noqa: E402
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--hosts",
+        type=int,
+        nargs="+",
+        default=[1000, 10000, 100000],
+        help="Number of hosts, one benchmark per value",
+    )
+    parser.add_argument(
+        "--packages", type=int, default=50, help="Packages per inventory tree"
+    )
+    parser.add_argument(
+        "--workers", type=int, default=1, help="Worker processes of lpds_hwswtree"
+    )
+    parser.add_argument(
+        "--no-tracemalloc",
+        action="store_true",
+        help="Do not trace memory allocations (faster, no peak memory per phase)",
+    )
+    parser.add_argument("--json", help="Write results as JSON to file")
+    parser.add_argument("--keep", action="store_true", help="Keep generated data")
+    return parser.parse_args()
+
+
+def load_cli():
+    """Import bin/labelpicker as module to use its merge and write functions"""
+    loader = SourceFileLoader("labelpicker_cli", os.path.join(REPO_DIR, "bin", "labelpicker"))
+    spec = importlib.util.spec_from_loader(loader.name, loader)
+    module = importlib.util.module_from_spec(spec)
+    loader.exec_module(module)
+    return module
+
+
+class Benchmark:
+    def __init__(self, hosts, servers, trace=True):
+        self.hosts = hosts
+        self.servers = servers
+        self.trace = trace
+        self.results = []
+
+    def measure(self, phase, func, *args, **kwargs):
+        """Run func and record wall time, REST requests and peak memory"""
+        requests_before = sum(server.requests for server in self.servers)
+        if self.trace:
+            tracemalloc.reset_peak()
+            memory_before = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        # labelpicker prints a line per host, which would dominate the timing
+        with redirect_stdout(io.StringIO()):
+            result = func(*args, **kwargs)
+        seconds = time.perf_counter() - start
+        peak = None
+        if self.trace:
+            peak = round((tracemalloc.get_traced_memory()[1] - memory_before) / 1024 / 1024, 1)
+        self.results.append(
+            {
+                "hosts": self.hosts,
+                "phase": phase,
+                "seconds": round(seconds, 3),
+                "requests": sum(server.requests for server in self.servers) - requests_before,
+                "peak_mib": peak,
+            }
+        )
+        return result
+
+
+def run(hosts, args, cli, workdir):
+    inventory_dir = os.path.join(workdir, "inventory")
+    csv_file = os.path.join(workdir, "labels.csv")
+    print(f"Generating data for {hosts} hosts in {workdir}", file=sys.stderr)
+    synthetic.write_inventory(inventory_dir, hosts, args.packages)
+    synthetic.write_csv(csv_file, hosts)
+
+    checkmk = FakeCheckmk(synthetic.cmk_hosts(hosts)).start()
+    vsphere = FakeVSphere(*synthetic.vsphere_catalogue(hosts)).start()
+    # Every VM has to be listed, the unfiltered VM list is capped by vCenter
+    vsphere.max_vms = max(vsphere.max_vms, hosts)
+    bench = Benchmark(hosts, [checkmk, vsphere], trace=not args.no_tracemalloc)
+    try:
+        datasources = {
+            "hwswtree": (
+                lpds_hwswtree(),
+                {
+                    "label_prefix": "hwsw",
+                    "inventory_dir": inventory_dir,
+                    "mapping": synthetic.HWSWTREE_MAPPING,
+                    "workers": args.workers,
+                },
+            ),
+            "csv": (lpds_csv(), {"label_prefix": "csv", "csv_files": [csv_file]}),
+            "vsphere": (
+                lpds_vsphere(),
+                {
+                    "label_prefix": "vsphere",
+                    "api_url": vsphere.api_url,
+                    "api_user": "bench",
+                    "api_pass": "bench",
+                },
+            ),
+        }
+        label_updates = {}
+        for name, (strategy, strategy_config) in datasources.items():
+            processor = lpb.LableDataProcessor(strategy)
+            labels = bench.measure(
+                f"source {name}", lambda: dict(processor.stream(**strategy_config))
+            )
+            for host, host_labels in labels.items():
+                label_updates.setdefault(host, []).append(
+                    (name, strategy_config["label_prefix"], host_labels)
+                )
+            del labels
+
+        wato = lpb.CMKInstance(url=checkmk.api_url, password="bench")
+        cmk_all_hosts = bench.measure(
+            "host fetch",
+            wato.get_all_hosts,
+            fields=cli.HOST_FIELDS,
+            effective_fields=cli.HOST_EFFECTIVE_FIELDS,
+        )
+        pending_labels = bench.measure(
+            "diff", cli.merge_labels, wato, cmk_all_hosts, label_updates
+        )
+        bench.measure("write", cli.write_labels, wato, pending_labels, {})
+        bench.measure("activation", wato.activate)
+    finally:
+        checkmk.stop()
+        vsphere.stop()
+    return bench.results
+
+
+def print_results(results):
+    print(f"{'hosts':>8} {'phase':<18} {'seconds':>9} {'requests':>9} {'peak MiB':>9}")
+    for result in results:
+        peak = "-" if result["peak_mib"] is None else result["peak_mib"]
+        print(
+            f"{result['hosts']:>8} {result['phase']:<18} {result['seconds']:>9} "
+            f"{result['requests']:>9} {peak:>9}"
+        )
+
+
+def main():
+    args = parse_args()
+    cli = load_cli()
+    if not args.no_tracemalloc:
+        tracemalloc.start()
+    results = []
+    for hosts in args.hosts:
+        workdir = tempfile.mkdtemp(prefix=f"labelpicker-bench-{hosts}-")
+        try:
+            results += run(hosts, args, cli, workdir)
+        finally:
+            if not args.keep:
+                shutil.rmtree(workdir)
+    print_results(results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8; py-indent-offset: 4 -*-
+
+# SPDX-FileCopyrightText: © 2023 PL Automation Monitoring GmbH <pl@automation-monitoring.com>
+# SPDX-License-Identifier: GPL-3.0-or-later
+# This file is part of the Checkmk Labelpicker project (https://labelpicker.mk)
+
+"""Local stand-ins for the Checkmk REST API and the vSphere REST API
+Only the endpoints used by CMKInstance and vSphereAPI are implemented.
+"""
+
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        return json.loads(body) if body else {}
+
+    def _send(self, status, data, headers=None):
+        body = data if isinstance(data, bytes) else json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _dispatch(self, method):
+        self.server.count_request()
+        url = urlparse(self.path)
+        handler = getattr(self.server, f"handle_{method}")
+        status, data, headers = handler(url.path, parse_qs(url.query), self._body())
+        self._send(status, data, headers)
+
+    def do_GET(self):
+        self._dispatch("get")
+
+    def do_PUT(self):
+        self._dispatch("put")
+
+    def do_POST(self):
+        self._dispatch("post")
+
+
+class _FakeServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), _Handler)
+        self.requests = 0
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_port}"
+
+    def count_request(self):
+        with self._lock:
+            self.requests += 1
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def handle_get(self, path, query, body):
+        return 404, {"title": "Not found"}, None
+
+    handle_put = handle_get
+    handle_post = handle_get
+
+
+class FakeCheckmk(_FakeServer):
+    """Checkmk REST API: host_config objects and collections, bulk-update, activation"""
+
+    def __init__(self, hosts):
+        super().__init__()
+        self.hosts = hosts
+        self.activations = []
+        self._collection = None
+
+    @property
+    def api_url(self):
+        return f"{self.url}/site/check_mk/api/1.0"
+
+    def _host_data(self, hostname, effective=False):
+        extensions = self.hosts[hostname]
+        if effective:
+            # hosts without site attribute inherit the site of the root folder
+            extensions = {
+                **extensions,
+                "effective_attributes": {"site": "bench", **extensions["attributes"]},
+            }
+        return {"id": hostname, "domainType": "host_config", "extensions": extensions}
+
+    def _effective(self, query):
+        return query.get("effective_attributes", ["false"])[0] == "true"
+
+    def handle_get(self, path, query, body):
+        if path.endswith("/domain-types/host_config/collections/all"):
+            # serialize once, the fake server must not be the bottleneck
+            effective = self._effective(query)
+            if self._collection is None or self._collection[0] != effective:
+                self._collection = effective, json.dumps(
+                    {
+                        "links": [],
+                        "id": "host",
+                        "domainType": "host_config",
+                        "value": [self._host_data(host, effective) for host in self.hosts],
+                        "extensions": {},
+                    }
+                ).encode()
+            return 200, self._collection[1], None
+        if "/objects/host_config/" in path:
+            hostname = path.rsplit("/", 1)[1]
+            if hostname not in self.hosts:
+                return 404, {"title": "Not Found"}, None
+            return 200, self._host_data(hostname, self._effective(query)), {"ETag": '"fake"'}
+        if path.endswith("/domain-types/activation_run/collections/pending_changes"):
+            return 200, {"value": []}, None
+        return super().handle_get(path, query, body)
+
+    def _update(self, hostname, entry):
+        attributes = self.hosts[hostname]["attributes"]
+        attributes.update(entry.get("attributes") or entry.get("update_attributes") or {})
+        for attr in entry.get("remove_attributes") or []:
+            attributes.pop(attr, None)
+        self._collection = None
+
+    def handle_put(self, path, query, body):
+        if path.endswith("/domain-types/host_config/actions/bulk-update/invoke"):
+            failed = {}
+            for entry in body.get("entries", []):
+                if entry["host_name"] in self.hosts:
+                    self._update(entry["host_name"], entry)
+                else:
+                    failed[entry["host_name"]] = "Host not found"
+            if failed:
+                return 400, {"title": "Some hosts could not be updated", "ext": {"failed_hosts": failed}}, None
+            return 200, {"value": []}, None
+        if "/objects/host_config/" in path:
+            hostname = path.rsplit("/", 1)[1]
+            if hostname not in self.hosts:
+                return 404, {"title": "Not Found"}, None
+            self._update(hostname, body)
+            return 200, self._host_data(hostname), {"ETag": '"fake"'}
+        return super().handle_put(path, query, body)
+
+    def handle_post(self, path, query, body):
+        if path.endswith("/domain-types/activation_run/actions/activate-changes/invoke"):
+            self.activations.append(body)
+            return 200, {"title": "Activation status: In progress."}, None
+        return super().handle_post(path, query, body)
+
+
+class FakeVSphere(_FakeServer):
+    """vSphere REST API: session, VM list, tagging and tag associations"""
+
+    # /vcenter/vm refuses to list more VMs without a filter
+    max_vms = 1000
+
+    def __init__(self, vms, tags, categories, associations):
+        super().__init__()
+        self.vms = vms
+        self.tags = tags
+        self.categories = categories
+        self.associations = associations
+
+    @property
+    def api_url(self):
+        return f"{self.url}/rest"
+
+    def handle_get(self, path, query, body):
+        if path.endswith("/vcenter/vm"):
+            vms = self._filter(self.vms, query)
+            if len(vms) > self.max_vms:
+                return 400, {"type": "com.vmware.vapi.std.errors.unable_to_allocate_resource"}, None
+            return 200, {"value": [{"vm": vm["vm"], "name": vm["name"]} for vm in vms]}, None
+        for kind in ("datacenter", "cluster", "host"):
+            if path.endswith(f"/vcenter/{kind}"):
+                ids = sorted({self._location(vm)[kind] for vm in self._filter(self.vms, query)})
+                return 200, {"value": [{kind: i, "name": i} for i in ids]}, None
+        if "/com/vmware/cis/tagging/tag/id:" in path:
+            return 200, {"value": self.tags[path.split("id:", 1)[1]]}, None
+        if "/com/vmware/cis/tagging/category/id:" in path:
+            return 200, {"value": self.categories[path.split("id:", 1)[1]]}, None
+        return super().handle_get(path, query, body)
+
+    def _location(self, vm):
+        # one datacenter, one ESXi host per cluster
+        return {"datacenter": "datacenter-1", "cluster": vm["cluster"], "host": f"host-{vm['cluster']}"}
+
+    def _filter(self, vms, query):
+        for kind in ("datacenter", "cluster", "host"):
+            if f"filter.{kind}s" in query:
+                ids = set(query[f"filter.{kind}s"])
+                vms = [vm for vm in vms if self._location(vm)[kind] in ids]
+        if "filter.names" in query:
+            names = set(query["filter.names"])
+            vms = [vm for vm in vms if vm["name"] in names]
+        return vms
+
+    def handle_post(self, path, query, body):
+        if path.endswith("/com/vmware/cis/session"):
+            return 200, {"value": "fake-session-id"}, None
+        action = query.get("~action", [""])[0]
+        if action == "list-attached-tags-on-objects":
+            value = [
+                {"object_id": obj, "tag_ids": self.associations[obj["id"]]}
+                for obj in body.get("object_ids", [])
+                if obj["id"] in self.associations
+            ]
+            return 200, {"value": value}, None
+        if action == "list-attached-tags":
+            return 200, {"value": self.associations.get(body["object_id"]["id"], [])}, None
+        return super().handle_post(path, query, body)
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8; py-indent-offset: 4 -*-
+
+# SPDX-FileCopyrightText: © 2023 PL Automation Monitoring GmbH <pl@automation-monitoring.com>
+# SPDX-License-Identifier: GPL-3.0-or-later
+# This file is part of the Checkmk Labelpicker project (https://labelpicker.mk)
+
+"""Synthetic datasource data for labelpicker benchmarks"""
+
+import os
+import random
+
+OS_NAMES = [
+    "Ubuntu 22.04.3 LTS",
+    "Ubuntu 20.04.6 LTS",
+    "Red Hat Enterprise Linux 8.8",
+    "Microsoft Windows Server 2019 Standard",
+    "Microsoft Windows Server 2022 Datacenter",
+]
+PRODUCTS = ["VMware Virtual Platform", "ProLiant DL380 Gen10", "PowerEdge R740"]
+PACKAGES = [f"package{i}" for i in range(500)] + ["apache2", "nginx", "openssh-server"]
+
+# Mapping for lpds_hwswtree matching the generated inventory trees
+HWSWTREE_MAPPING = [
+    {
+        "labelname": "os_name",
+        "tree": ["Software", "Operating System", "Name"],
+        "match_group_filters": [
+            ["Microsoft Windows Server (\\d+) (.*)", "Win Server \\1"],
+            "(Ubuntu \\d+\\.\\d+)",
+        ],
+    },
+    {"labelname": "os_version", "tree": ["Software", "Operating System", "Version"]},
+    {"labelname": "product", "tree": ["Hardware", "System", "Product"]},
+    {"labelname": "model", "tree": ["Hardware", "System", "Model Name"]},
+    {"labelname": "cpu_model", "tree": ["Hardware", "CPU", "Model"]},
+    {"labelname": "apache_version", "tree": ["Software", "Packages", "Apache2"]},
+    {"labelname": "nginx_version", "tree": ["Software", "Packages", "Nginx"]},
+    {"labelname": "ssh_version", "tree": ["Software", "Packages", "openssh-server"]},
+    {"labelname": "gateway", "tree": ["Networking", "Routes", "Default"]},
+]
+
+
+def hostname(index):
+    return f"host{index:06d}"
+
+
+def _node(attributes=None, nodes=None, rows=None):
+    return {
+        "Attributes": {"Pairs": attributes} if attributes else {},
+        "Nodes": nodes or {},
+        "Table": {"KeyColumns": [], "Rows": rows} if rows else {},
+    }
+
+
+def inventory_tree(index, packages=50):
+    """Inventory tree of one host in the structure of var/check_mk/inventory"""
+    rnd = random.Random(index)
+    package_rows = [
+        {"name": name, "version": f"{rnd.randint(1, 9)}.{rnd.randint(0, 40)}"}
+        for name in rnd.sample(PACKAGES, packages)
+    ]
+    return _node(
+        nodes={
+            "hardware": _node(
+                nodes={
+                    "system": _node(
+                        {"product": rnd.choice(PRODUCTS), "model": f"M{index % 7}"}
+                    ),
+                    "cpu": _node({"model": "Intel(R) Xeon(R) Gold 6248R", "cores": 24}),
+                }
+            ),
+            "software": _node(
+                nodes={
+                    "os": _node(
+                        {"name": rnd.choice(OS_NAMES), "version": f"{index % 5}.0"}
+                    ),
+                    "packages": _node(rows=package_rows),
+                }
+            ),
+            "networking": _node(
+                {"total_interfaces": 4},
+                nodes={
+                    "routes": _node(
+                        rows=[
+                            {"target": "0.0.0.0/0", "gateway": f"10.{index % 250}.0.1"},
+                            {"target": "10.0.0.0/8", "gateway": "10.0.0.1"},
+                        ]
+                    )
+                },
+            ),
+        }
+    )
+
+
+def write_inventory(directory, hosts, packages=50):
+    """Write inventory files of hosts to directory, like var/check_mk/inventory"""
+    os.makedirs(directory, exist_ok=True)
+    for index in range(hosts):
+        with open(os.path.join(directory, hostname(index)), "w") as f:
+            f.write(repr(inventory_tree(index, packages)))
+        # compressed copies exist next to the inventory files and must be ignored
+        if index % 100 == 0:
+            open(os.path.join(directory, f"{hostname(index)}.gz"), "w").close()
+
+
+def write_csv(path, hosts, labels=5):
+    """Write a semicolon separated CSV file with one row of labels per host"""
+    with open(path, "w") as f:
+        f.write("host;labels\n")
+        for index in range(hosts):
+            row = ",".join(
+                f"key{n}:value{(index + n) % 17}" for n in range(labels)
+            )
+            f.write(f"{hostname(index)};{row}\n")
+
+
+def vsphere_catalogue(hosts, tags=200, categories=20, tags_per_vm=3):
+    """Fake vSphere inventory
+
+    Returns:
+        (vms, tags, categories, associations)
+    """
+    rnd = random.Random(hosts)
+    categories = {
+        f"urn:cat:{n}": {"id": f"urn:cat:{n}", "name": f"Category{n}"}
+        for n in range(categories)
+    }
+    category_ids = list(categories)
+    tags = {
+        f"urn:tag:{n}": {
+            "id": f"urn:tag:{n}",
+            "name": f"Tag{n}",
+            "category_id": category_ids[n % len(category_ids)],
+        }
+        for n in range(tags)
+    }
+    tag_ids = list(tags)
+    vms = [
+        {"vm": f"vm-{index}", "name": hostname(index), "cluster": f"domain-c{index % 10}"}
+        for index in range(hosts)
+    ]
+    associations = {
+        vm["vm"]: rnd.sample(tag_ids, tags_per_vm) for vm in vms if rnd.random() < 0.9
+    }
+    return vms, tags, categories, associations
+
+
+def cmk_hosts(hosts, sites=1):
+    """Host collection of a Checkmk site, every second host already has some labels"""
+    collection = {}
+    for index in range(hosts):
+        labels = {"cmk/custom": "yes"}
+        if index % 2:
+            labels["hwsw/os_name"] = "outdated"
+        collection[hostname(index)] = {
+            "attributes": {"labels": labels, "site": f"site{index % sites}"},
+            "effective_attributes": None,
+            "is_cluster": False,
+            "is_offline": False,
+            "folder": "/",
+        }
+    return collection
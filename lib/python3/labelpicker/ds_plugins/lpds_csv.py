@@ -5,41 +5,134 @@
 # SPDX-License-Identifier: GPL-3.0-or-later
 # This file is part of the Checkmk Labelpicker project (https://labelpicker.mk)
 
-from labelpicker.labelpicker_base import Strategy
+from labelpicker.labelpicker_base import Strategy, host_selector, HOST_SELECTION
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 import os
 import csv
 
 
+def _parse_row(row):
+    """Parse a CSV row: host;label1:value1,label2:value2
+    Returns (host, labels) or None if the row is invalid
+    """
+    if len(row) < 2 or not row[0]:
+        return None
+    labels = {}
+    for label in row[1].split(","):
+        if ":" not in label:
+            return None
+        # values may contain colons, e.g. URLs
+        k, v = label.split(":", 1)
+        if not k.strip():
+            return None
+        labels[k.strip()] = v.strip()
+    return row[0], labels
+
+
+def _merge_labels(collected, host, labels, duplicates):
+    """Add labels of host to collected, honor duplicates setting if host is already known
+    replace: labels of the last row win
+    merge: labels of all rows are merged, later rows override single labels
+    first: labels of the first row win
+    """
+    if host not in collected or duplicates == "replace":
+        collected[host] = labels
+    elif duplicates == "merge":
+        collected[host].update(labels)
+
+
+def _read_csv_file(csv_file, duplicates, selection):
+    """Read one CSV file row by row
+    Rows of hosts not matching the selection (kwargs of host_selector) are skipped unparsed
+
+    Returns:
+        (labels, invalid_rows): labels is a dict host -> labels
+    """
+    collected = {}
+    invalid_rows = 0
+    selected = host_selector(**selection)
+    with open(csv_file, "r", newline="") as f:
+        reader = csv.reader(f, delimiter=";")
+        # skip first row (header)
+        next(reader, None)
+        for row in reader:
+            # skip empty lines
+            if not row:
+                continue
+            if selected and not selected(row[0]):
+                continue
+            parsed = _parse_row(row)
+            if parsed is None:
+                invalid_rows += 1
+                continue
+            _merge_labels(collected, parsed[0], parsed[1], duplicates)
+    return collected, invalid_rows
+
+
 class lpds_csv(Strategy):
     """CSV strategy"""
 
     def source_algorithm(self, **kwargs) -> dict:
-        parsed = []
-        csv_files = kwargs.get("csv_files", [])
-
-        for csv_file in csv_files:
-            if os.path.isfile(csv_file):
-                # read csv file
-                with open(csv_file, "r") as f:
-                    reader = csv.reader(f, delimiter=";")
-                    for row in reader:
-                        # add row to parsed list but skip first row (header)
-                        if not reader.line_num == 1:
-                            parsed.append(row)
-        return parsed
+        """Read all CSV files and return dict host -> labels (without label prefix)
+        Files are read in parallel with workers > 1 (0 = one process per cpu core),
+        labels of hosts in multiple rows or files are combined as set by duplicate_hosts.
+        With a host selection (hosts, host_regex, shard) only the rows of these hosts are kept.
+        """
+        csv_files = [
+            csv_file
+            for csv_file in kwargs.get("csv_files", [])
+            if os.path.isfile(csv_file)
+        ]
+        duplicates = kwargs.get("duplicate_hosts", "merge")
+        if duplicates not in ("replace", "merge", "first"):
+            print(f"Unknown duplicate_hosts setting {duplicates}, using merge")
+            duplicates = "merge"
+        workers = kwargs.get("workers", 1)
+        if workers == 0:
+            workers = os.cpu_count() or 1
+        selection = {key: kwargs[key] for key in HOST_SELECTION if key in kwargs}
+
+        if workers > 1 and len(csv_files) > 1:
+            workers = min(workers, len(csv_files))
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                results = list(
+                    executor.map(
+                        _read_csv_file, csv_files, repeat(duplicates), repeat(selection)
+                    )
+                )
+        else:
+            results = map(
+                _read_csv_file, csv_files, repeat(duplicates), repeat(selection)
+            )
+
+        # combine files in config order, so the result does not depend on the workers
+        collected = {}
+        for csv_file, (labels, invalid_rows) in zip(csv_files, results):
+            if invalid_rows:
+                print(f"Skipped {invalid_rows} invalid rows in file {csv_file}")
+            for host, host_labels in labels.items():
+                _merge_labels(collected, host, host_labels, duplicates)
+        return collected
 
     def process_algorithm(self, source, **kwargs) -> dict:
         """Process source data and return dict"""
-        collected_labels = {}
-        label_prefix = kwargs.get("label_prefix", None)
-        for row in source:
-            host = row[0]
-            collected_labels[host] = {}
-            # update collected_labels with host and label
-            for label in row[1].split(","):
-                k, v = label.split(":")
-                if label_prefix:
-                    k = f"{label_prefix}/{k}"
-                collected_labels[host].update({k.strip(): v.strip()})
-
-        return collected_labels
+        return dict(self._add_prefix(source, kwargs.get("label_prefix", None)))
+
+    def stream_algorithm(self, **kwargs):
+        """Yield (host, labels) of all CSV files"""
+        with self.phase("source"):
+            source = self.source_algorithm(**kwargs)
+        yield from self.timed(
+            self._add_prefix(source, kwargs.get("label_prefix", None)), "process"
+        )
+
+    def watch_paths(self, **kwargs) -> list:
+        """A change of any CSV file triggers a new read of all files"""
+        return list(kwargs.get("csv_files", []))
+
+    def _add_prefix(self, source, label_prefix):
+        for host, labels in source.items():
+            if label_prefix:
+                labels = {f"{label_prefix}/{k}": v for k, v in labels.items()}
+            yield host, labels
@@ -9,16 +9,173 @@
 # LHM (Landeshauptstadt Muenchen): This Datasource Plugin was developed in cooperation with the "Eigenbetrieb it@M" of the City of Munich.
 
 
-from labelpicker.labelpicker_base import Strategy
+from labelpicker.labelpicker_base import Strategy, atomic_write, host_selector, shard_path
 import re
 import os
 import ast
+import json
+import hashlib
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from functools import lru_cache
 #from cmk.gui.plugins.views import builtin_inventory_plugins
 
+# Files in the inventory directory which are no inventory trees: hidden files and .gz copies
+IGNORED_FILES = re.compile(r"(^\.|.*\.gz$)")
+
+
+class InventoryCache:
+    """On-disk cache of label values extracted from inventory files
+    Entries are keyed by file path and only valid as long as mtime and size of the file are unchanged.
+    The cache is bound to the inventory trees of the mapping, a changed mapping invalidates all entries.
+    """
+
+    def __init__(self, cache_file, mapping_digest, reset=False):
+        self.cache_file = cache_file
+        self.mapping_digest = mapping_digest
+        self.entries = {}
+        self.seen = set()
+        if reset or not os.path.exists(cache_file):
+            return
+        try:
+            with open(cache_file, "r") as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Could not read inventory cache {cache_file}: {e}")
+            return
+        if data.get("mapping") == mapping_digest:
+            self.entries = data.get("entries", {})
+
+    def get(self, path, stat):
+        """Return cached values for path or None if file changed since caching"""
+        self.seen.add(path)
+        entry = self.entries.get(path)
+        if entry and entry[0] == stat.st_mtime_ns and entry[1] == stat.st_size:
+            return entry[2]
+        return None
+
+    def set(self, path, stat, values):
+        self.seen.add(path)
+        self.entries[path] = [stat.st_mtime_ns, stat.st_size, values]
+
+    def save(self, prune=True):
+        """Write cache to disk, with prune entries of files not seen in this run are removed"""
+        if prune:
+            entries = {
+                path: self.entries[path] for path in self.seen if path in self.entries
+            }
+        else:
+            entries = self.entries
+        atomic_write(
+            self.cache_file,
+            json.dumps({"mapping": self.mapping_digest, "entries": entries}),
+        )
+
+
+class ValueFilters:
+    """match_group_filters of all mapping definitions, compiled once per run
+    A filter is either a regex (result: first match group) or a list [regex, replacement]
+    with match groups referenced as \\1, \\2, ... in the replacement, the first matching
+    filter of a definition wins. Most raw values repeat across hosts (e.g. the OS name),
+    so results are memoized per (definition, raw value) in a cache of cache_size values.
+    """
+
+    def __init__(self, mapping, keys, cache_size=65536):
+        self.keys = keys
+        self.filters = [
+            self._compile(definition.get("match_group_filters", None) or [], k)
+            for definition, k in zip(mapping, keys)
+        ]
+        # filters which raised an error are skipped for the rest of the run
+        self.failed = set()
+        self.apply = lru_cache(maxsize=cache_size)(self._apply)
+
+    def _compile(self, match_group_filters, k):
+        """Returns list of (regex, replacement parts) of valid filters
+        Replacement parts alternate between literal text and match group numbers.
+        """
+        compiled = []
+        for filter in match_group_filters:
+            try:
+                if type(filter) is str:
+                    # if filter is a string, switch to simple match -> first group
+                    regex, re_modified = filter, r"\1"
+                elif type(filter) is list:
+                    # if filter is a list, use first element as regex and second element as modified regex
+                    regex, re_modified = filter[0], filter[1]
+                else:
+                    raise TypeError(f"filter {filter!r} is neither string nor list")
+                parts = re.split(r"\\(\d+)", re_modified)
+                parts[1::2] = [int(group) for group in parts[1::2]]
+                compiled.append((re.compile(regex), parts))
+            except Exception as e:
+                print(
+                    f"ERROR: Could not apply match_group_filters to {k}. Exception: {e}"
+                )
+        return compiled
+
+    def __call__(self, index, value):
+        """Filtered value of the mapping definition index"""
+        if not self.filters[index]:
+            return value
+        return self.apply(index, value)
+
+    def _apply(self, index, value):
+        for position, (pattern, parts) in enumerate(self.filters[index]):
+            if (index, position) in self.failed:
+                continue
+            try:
+                match = pattern.search(value)
+                if match:
+                    # substitute match groups in the replacement, unmatched groups are empty
+                    return "".join(
+                        (match.group(part) or "") if i % 2 else part
+                        for i, part in enumerate(parts)
+                    )
+            except Exception as e:
+                self.failed.add((index, position))
+                print(
+                    f"ERROR: Could not apply match_group_filters to {self.keys[index]}. Exception: {e}"
+                )
+        return value
+
+    def cache_info(self):
+        return self.apply.cache_info()
+
+
+def _parse_inventory_file(host, path, plan, count):
+    """Parse a single inventory file and extract the raw label values
+    Runs in worker processes, so only the small list of values is sent back.
+
+    Returns:
+        (values, error): error is None if the file could be parsed
+    """
+    with open(path, "r") as file:
+        content = file.read()
+    try:
+        data = ast.literal_eval(content)
+    except SyntaxError as e:
+        return None, f"Syntax error in file {host}: {e}"
+    except ValueError as e:
+        return None, f"Value error in file {host}: {e}"
+    return lpds_hwswtree()._extract_values(data, plan, count), None
+
 
 class lpds_hwswtree(Strategy):
     """HWSWTree strategy"""
 
+    # Parsing inventory files is CPU bound
+    executor = "process"
+
+    # Default key and value column of table rows by inventory node name,
+    # can be extended with table_columns in the datasource config
+    row_mapping = {
+        "packages": ("name", "version"),
+        "routes": ("target", "gateway"),
+        "interfaces": ("index", "speed"),
+    }
+
     def _translate_inv_tree(self, invtree):
         """Set values in invtree list to lowercase and map values if necessary"""
         invtree_translated = []
@@ -42,72 +199,229 @@ class lpds_hwswtree(Strategy):
         return invtree_translated
 
     def source_algorithm(self, **kwargs) -> dict:
-        """Parse Hardware/Software inventory data"""
-        inventory_dir = kwargs.get("inventory_dir", None)
-        if not inventory_dir:
-            inventory_dir = os.environ["HOME"] + "/var/check_mk/inventory"
+        """Parse Hardware/Software inventory data
+        Returns dict with host as key and list of raw label values (one per mapping definition) as value
+        """
+        return dict(self._iter_inventory(**kwargs))
+
+    def _iter_inventory(self, **kwargs):
+        """Parse Hardware/Software inventory data
+        Yields (host, list of raw label values) one host at a time,
+        with a host selection (hosts, host_regex, shard) only the inventory files of these hosts are read
+        """
+        inventory_dir = self._inventory_dir(**kwargs)
+        selected_hosts = kwargs.get("hosts", None)
+        selected = host_selector(**kwargs)
+        mapping = kwargs.get("mapping", None) or []
+        inv_trees = [self._translate_inv_tree(d["tree"]) for d in mapping]
+        table_columns = {
+            name.lower(): columns
+            for name, columns in (kwargs.get("table_columns", None) or {}).items()
+        }
+        tables = [
+            self._table_columns(definition, inv_tree, table_columns)
+            for definition, inv_tree in zip(mapping, inv_trees)
+        ]
+        plan = self._compile_plan(inv_trees, tables)
         debug = False
-        parsed = {}
         if debug:
             print(
                 f"DEBUG: Parsing Hardware/Software inventory data from {inventory_dir}"
             )
 
-        # iterate over all files in inventory_dir and evaluate them
-        for host in os.listdir(inventory_dir):
-            if not re.match("(^\.|.*\.gz$)", host):
-                if debug:
-                    print(f"DEBUG: Parsing {host}")
-                with open(f"{inventory_dir}/{host}", "r") as file:
-                    content = file.read()
-                    try:
-                        parsed[host] = ast.literal_eval(content)
-                    except SyntaxError as e:
-                        print(f"Syntax error in file {host}: {e}")
-                    except ValueError as e:
-                        print(f"Value error in file {host}: {e}")
-        return parsed
-
-    def _inspect_inv_dict(self, data, inv_tree, index=0):
-        """Try to get value from data by inv_tree
-        Search for keys Nodes, Attributes, Table
-        If behind this key is NOT an empty dict try to read Attributes or Table values
-        Else: try to use the inv_tree key to dig deeper via recursion.
+        cache = None
+        if kwargs.get("parse_cache", False):
+            cache_file = kwargs.get("parse_cache_file", None)
+            if not cache_file:
+                cache_file = os.environ["HOME"] + "/var/labelpicker/lpds_hwswtree.cache"
+            # shards run at the same time and must not overwrite each other's cache
+            cache = InventoryCache(
+                shard_path(cache_file, kwargs.get("shard", None)),
+                self._mapping_digest([inv_trees, tables]),
+                reset=kwargs.get("parse_cache_reset", False),
+            )
+
+        # iterate over all files in inventory_dir, use cached values where possible
+        pending = []
+        if selected_hosts is None:
+            host_files = os.listdir(inventory_dir)
+        else:
+            host_files = [
+                host
+                for host in selected_hosts
+                if os.path.isfile(f"{inventory_dir}/{host}")
+            ]
+        for host in host_files:
+            if selected and not selected(host):
+                continue
+            if not IGNORED_FILES.match(host):
+                path = f"{inventory_dir}/{host}"
+                stat = None
+                if cache:
+                    stat = os.stat(path)
+                    values = cache.get(path, stat)
+                    if values is not None:
+                        yield host, values
+                        continue
+                pending.append((host, path, stat))
+
+        # evaluate all other files, optionally distributed over multiple processes
+        # workers: 0 uses one process per cpu core
+        workers = kwargs.get("workers", 1)
+        if workers == 0:
+            workers = os.cpu_count() or 1
+        hosts = [host for host, _, _ in pending]
+        paths = [path for _, path, _ in pending]
+        if debug:
+            print(f"DEBUG: Parsing {len(paths)} files with {workers} worker(s)")
+        executor = None
+        if workers > 1 and len(paths) > 1:
+            executor = ProcessPoolExecutor(max_workers=workers)
+            chunksize = max(1, len(paths) // (workers * 4))
+            results = executor.map(
+                _parse_inventory_file,
+                hosts,
+                paths,
+                repeat(plan),
+                repeat(len(inv_trees)),
+                chunksize=chunksize,
+            )
+        else:
+            results = map(
+                _parse_inventory_file,
+                hosts,
+                paths,
+                repeat(plan),
+                repeat(len(inv_trees)),
+            )
+
+        try:
+            for (host, path, stat), (values, error) in zip(pending, results):
+                if error:
+                    print(error)
+                    continue
+                if cache:
+                    cache.set(path, stat, values)
+                yield host, values
+        finally:
+            if executor:
+                executor.shutdown(cancel_futures=True)
+
+        if cache:
+            # a run of selected hosts must not drop the entries of all other hosts,
+            # a shard has its own cache and reads all files of the shard
+            cache.save(prune=selected_hosts is None and not kwargs.get("host_regex"))
+
+    def _inventory_dir(self, **kwargs):
+        inventory_dir = kwargs.get("inventory_dir", None)
+        if not inventory_dir:
+            inventory_dir = os.environ["HOME"] + "/var/check_mk/inventory"
+        return inventory_dir
+
+    def watch_paths(self, **kwargs) -> list:
+        """Inventory files are written by Checkmk into one directory per site"""
+        return [self._inventory_dir(**kwargs)]
+
+    def changed_hosts(self, paths, **kwargs):
+        """Inventory files are named after the host, .gz copies are ignored"""
+        inventory_dir = os.path.normpath(self._inventory_dir(**kwargs))
+        hosts = set()
+        for path in paths:
+            path = os.path.normpath(path)
+            if path == inventory_dir:
+                return None
+            host = os.path.basename(path)
+            if os.path.dirname(path) == inventory_dir and not IGNORED_FILES.match(host):
+                hosts.add(host)
+        return hosts
+
+    def _mapping_digest(self, inv_trees):
+        """Digest of the inventory trees, used to invalidate cached values on mapping changes"""
+        return hashlib.sha1(json.dumps(inv_trees).encode()).hexdigest()
+
+    def _table_columns(self, definition, inv_tree, table_columns):
+        """Get key and value column to look up the last tree element in table rows
+        Lookup order:
+            table_columns of the mapping definition, e.g. [name, version]
+            table_columns of the datasource by tree path (e.g. software.applications.docker.containers)
+            table_columns of the datasource or row_mapping by node name (e.g. packages)
+        Returns None if the tree does not point into a table
         """
-        row_mapping = {
-            "packages": ("name", "version"),
-            "routes": ("target", "gateway"),
-            "interfaces": ("index", "speed"),
-        }
+        if len(inv_tree) < 2:
+            return None
+        if definition.get("table_columns"):
+            return list(definition["table_columns"])
+        for name in (".".join(inv_tree[:-1]), inv_tree[-2]):
+            if name in table_columns:
+                return list(table_columns[name])
+        if inv_tree[-2] in self.row_mapping:
+            return list(self.row_mapping[inv_tree[-2]])
+        return None
+
+    def _compile_plan(self, inv_trees, tables):
+        """Compile the inventory trees of the mapping into a prefix trie
+        Every trie node describes one node of the inventory tree:
+            nodes: child trie nodes by inventory node name
+            attributes: (index, key) pairs to read from Attributes/Pairs
+            table: (key column, value column) -> (index, key) pairs to read from Table/Rows
+        The index refers to the position of the tree in the mapping.
+        """
+        plan = self._new_plan_node()
+        for index, (inv_tree, columns) in enumerate(zip(inv_trees, tables)):
+            node = plan
+            for key in inv_tree[:-1]:
+                node = node["nodes"].setdefault(key, self._new_plan_node())
+            node["attributes"].append((index, inv_tree[-1]))
+            if columns:
+                node["table"].setdefault(tuple(columns), []).append(
+                    (index, inv_tree[-1])
+                )
+        return plan
+
+    def _new_plan_node(self):
+        return {"nodes": {}, "attributes": [], "table": {}}
+
+    def _extract_values(self, data, plan, count):
+        """Get raw label values for all trees of the compiled plan
+        by walking the inventory data once"""
+        values = [None] * count
+        self._walk_plan(data, plan, values)
+        return values
+
+    def _walk_plan(self, data, plan, values):
+        """Fill values with Attributes and Table content of data and dig deeper into Nodes
+        If Attributes, Nodes or Table is not in data it seems to be a structure of an old cmk version,
+        currently no parser is implemented for this, so it is skipped.
+        """
+        if plan["attributes"] and data.get("Attributes"):
+            pairs = data["Attributes"].get("Pairs", {})
+            for index, key in plan["attributes"]:
+                if key in pairs:
+                    values[index] = str(pairs[key])
+
+        if plan["table"] and data.get("Table"):
+            rows = data["Table"].get("Rows", [])
+            for (key_column, value_column), lookups in plan["table"].items():
+                row_index = self._index_rows(rows, key_column, value_column)
+                for index, key in lookups:
+                    if key in row_index:
+                        values[index] = row_index[key]
 
-        deep_inv_tree = len(inv_tree) - 1
-        self.label_content = None
-        cmk_inv_objects = ["Attributes", "Nodes", "Table"]
-        for obj in cmk_inv_objects:
-            # If Attributes, Nodes or Table is not in data continue it seems to be a structure of an old cmk version
-            # Currently no parser inplemented for this, so skip it
-            if not obj in data:
+        if plan["nodes"] and data.get("Nodes"):
+            for key, node_plan in plan["nodes"].items():
+                if key in data["Nodes"]:
+                    self._walk_plan(data["Nodes"][key], node_plan, values)
+
+    def _index_rows(self, rows, key_column, value_column):
+        """Index table rows by key column, the first row of a key wins"""
+        row_index = {}
+        for row in rows:
+            try:
+                row_index.setdefault(row.get(key_column), row.get(value_column))
+            except TypeError:
+                # unhashable key column value, can not be selected by a mapping anyway
                 continue
-            if not data[obj] == {}:
-                if obj == "Attributes" and index == deep_inv_tree:
-                    if "Pairs" in data[obj]:
-                        self.label_content = str(data[obj]["Pairs"][inv_tree[index]])
-                elif obj == "Table":
-                    if "Rows" in data[obj]:
-                        for id, rmap in row_mapping.items():
-                            if id == inv_tree[index - 1]:
-                                for row in data[obj]["Rows"]:
-                                    if row[rmap[0]] == inv_tree[index]:
-                                        self.label_content = row[rmap[1]]
-                                        break
-                else:
-                    # try to dig deeper
-                    try:
-                        self._inspect_inv_dict(
-                            data[obj][inv_tree[index]], inv_tree, index + 1
-                        )
-                    except KeyError:
-                        pass
+        return row_index
 
     def process_algorithm(self, source_data, **kwargs) -> dict:
         """Process source data and return dict
@@ -118,54 +432,56 @@ class lpds_hwswtree(Strategy):
             print("No mapping config found")
             return {}
 
-        filter_blacklist = []
-        for host, data in source_data.items():
+        keys = self._label_keys(mapping, kwargs.get("label_prefix", None))
+        filters = ValueFilters(mapping, keys, kwargs.get("transform_cache_size", 65536))
+        for host, values in source_data.items():
             # print("Processing host: {}".format(host))
-            for definition in mapping:
-                inv_tree = self._translate_inv_tree(definition["tree"])
-                self._inspect_inv_dict(data, inv_tree)
-                if self.label_content:
-                    # update collected_labels with host and label
-                    if host not in collected_labels:
-                        collected_labels[host] = {}
-                    # set label key depending on label_prefix
-                    if kwargs.get("label_prefix", None):
-                        k = "{}/{}".format(
-                            kwargs.get("label_prefix"), definition["labelname"]
-                        )
-                    else:
-                        k = definition["labelname"]
-                    # try to apply matchgroup filter if defined
-                    v = self.label_content
-                    match_group_filters = definition.get("match_group_filters", None)
-                    if match_group_filters:
-                        for filter in match_group_filters:
-                            if type(filter) is str:
-                                # if filter is a string, switch to simple match -> first group
-                                regex = filter
-                                re_modified = r"\1"
-                            elif type(filter) is list:
-                                # if filter is a list, use first element as regex and second element as modified regex
-                                regex = filter[0]
-                                re_modified = filter[1]
-
-                            if filter not in filter_blacklist:
-                                try:
-                                    match = re.search(regex, v)
-                                    if match:
-                                        # substitute match groups in re_modified string
-                                        v = re.sub(
-                                            r"\\(\d+)",
-                                            lambda m: match.group(int(m.group(1))),
-                                            re_modified,
-                                        )
-                                        break
-                                except Exception as e:
-                                    filter_blacklist.append(filter)
-                                    print(
-                                        f"ERROR: Could not apply match_group_filters to {k}. Exception: {e}"
-                                    )
-                    collected_labels[host].update({k: v})
-
-                    # print(f"{host} -> {definition['labelname']} -> {v}")
+            labels = self._build_labels(values, keys, filters)
+            if labels:
+                collected_labels[host] = labels
+        self._count_cache(filters)
         return collected_labels
+
+    def stream_algorithm(self, **kwargs):
+        """Yield (host, labels) while parsing, so inventory data of one host
+        can be freed before the next host is parsed
+        Parsing is accounted as source, building the labels as process"""
+        mapping = kwargs.get("mapping", None)
+        if not mapping:
+            print("No mapping config found")
+            return
+
+        keys = self._label_keys(mapping, kwargs.get("label_prefix", None))
+        filters = ValueFilters(mapping, keys, kwargs.get("transform_cache_size", 65536))
+        process_time = 0.0
+        try:
+            for host, values in self.timed(self._iter_inventory(**kwargs), "source"):
+                start = time.perf_counter()
+                labels = self._build_labels(values, keys, filters)
+                process_time += time.perf_counter() - start
+                if labels:
+                    yield host, labels
+        finally:
+            self._count_cache(filters)
+            if self.metrics:
+                self.metrics.add_time("process", process_time)
+
+    def _label_keys(self, mapping, label_prefix):
+        """Label key of each mapping definition depending on label_prefix"""
+        if label_prefix:
+            return [f"{label_prefix}/{d['labelname']}" for d in mapping]
+        return [d["labelname"] for d in mapping]
+
+    def _build_labels(self, values, keys, filters) -> dict:
+        """Create labels of one host from its raw label values"""
+        labels = {}
+        for index, label_content in enumerate(values):
+            if label_content:
+                # apply matchgroup filters if defined
+                labels[keys[index]] = filters(index, label_content)
+        return labels
+
+    def _count_cache(self, filters):
+        if self.metrics:
+            info = filters.cache_info()
+            self.metrics.count_cache("match_group_filters", info.hits, info.misses)
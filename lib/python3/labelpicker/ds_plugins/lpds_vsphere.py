@@ -7,47 +7,62 @@
 # Thanks to:
 # Abraxas Informatik AG: This Datasource Plugin was developed in cooperation with the "Abraxas Informatik AG".
 
-from labelpicker.labelpicker_base import Strategy
+from labelpicker.labelpicker_base import Strategy, atomic_write, host_selector, shard_path
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
 import json
+import os
+import time
+import threading
 import requests
 
 # from requests.auth import HTTPBasicAuth
+from requests.adapters import HTTPAdapter
 from requests.packages.urllib3.exceptions import InsecureRequestWarning
 
 
-import requests
-
-
 class vSphereAPI:
-    def __init__(self, api_url, api_user, api_pass, verify_ssl=True):
+    def __init__(
+        self, api_url, api_user, api_pass, verify_ssl=True, workers=8, metrics=None
+    ):
         self.api_url = api_url
         self.api_user = api_user
         self.api_pass = api_pass
         self.verify_ssl = verify_ssl
+        self.workers = workers
+        self.metrics = metrics
         # Disable SSL warnings if verify = false
         if not verify_ssl:
             requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
+        # Keep connections open and allow one connection per worker thread
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.verify = verify_ssl
         self.sid = self.auth_vcenter()
 
     def auth_vcenter(self):
         url = "{}/com/vmware/cis/session".format(self.api_url)
-        resp = requests.post(
-            url, auth=(self.api_user, self.api_pass), verify=self.verify_ssl
-        )
+        resp = self.session.post(url, auth=(self.api_user, self.api_pass))
+        self.count_request(resp)
         if resp.status_code != 200:
             self.print_error(resp, "API authentication failed")
             return None
         return resp.json().get("value")
 
     def make_request(self, method, url, headers=None, data=None):
-        resp = requests.request(
-            method, url, headers=headers, data=data, verify=self.verify_ssl
-        )
+        resp = self.session.request(method, url, headers=headers, data=data)
+        self.count_request(resp)
         if resp.status_code != 200:
             self.print_error(resp, "API request failed")
             return None
         return resp
 
+    def count_request(self, resp):
+        if self.metrics:
+            self.metrics.count_request(resp)
+
     def print_error(self, response, message):
         print(f"Error! {message}: {response.status_code}")
         print("Error! API responded with Message: {}".format(response.text))
@@ -66,10 +81,74 @@ class vSphereAPI:
         resp = self.make_request("POST", req_url, headers=headers, data=data)
         return resp.json() if resp else None
 
-    def get_all_vms(self):
-        resp = self.get_api_data(f"{self.api_url}/vcenter/vm")
+    def get_vms(self, filters=None):
+        """List VMs matching the filters, e.g. {"filter.clusters": "domain-c8"}
+        Returns None if the request failed, e.g. because the result exceeds the limit of the vCenter
+        """
+        query = f"?{urlencode(filters, doseq=True)}" if filters else ""
+        resp = self.get_api_data(f"{self.api_url}/vcenter/vm{query}")
         return resp.get("value") if resp else None
 
+    def list_objects(self, kind, filters=None):
+        """List ids of inventory objects (datacenters, clusters, hosts, folders) matching the filters"""
+        filters = dict(filters or {})
+        if kind == "folders":
+            filters["filter.type"] = "VIRTUAL_MACHINE"
+        query = f"?{urlencode(filters)}" if filters else ""
+        resp = self.get_api_data(f"{self.api_url}/vcenter/{kind[:-1]}{query}")
+        if not resp:
+            return None
+        return [item[kind[:-1]] for item in resp.get("value", [])]
+
+    def get_all_vms(
+        self, partition=("datacenters", "hosts"), vm_limit=1000, executor=None, names=None
+    ):
+        """List all VMs (with names only the VMs of these names), split into queries per
+        inventory object if the list is too large
+        /vcenter/vm returns at most vm_limit VMs, lists hitting the limit are split
+        by the next kind of partition, e.g. per datacenter and within a datacenter per host.
+        Returns list of VMs, each VM once
+        """
+        vms = {}
+        pending = [{}]
+        if names is not None:
+            names = sorted(names)
+            size = max(1, vm_limit - 1)
+            pending = [
+                {"filter.names": names[i : i + size]}
+                for i in range(0, len(names), size)
+            ]
+        kinds = list(partition)
+        while pending:
+            results = (executor.map if executor else map)(self.get_vms, pending)
+            split = []
+            for filters, result in zip(pending, results):
+                if result is not None and len(result) < vm_limit:
+                    for vm in result:
+                        vms.setdefault(vm["vm"], vm)
+                    continue
+                if not kinds:
+                    print(f"VM list of {self.api_url} may be incomplete: {filters}")
+                    for vm in result or []:
+                        vms.setdefault(vm["vm"], vm)
+                    continue
+                split.append(filters)
+            if not split:
+                break
+            kind = kinds.pop(0)
+            pending = []
+            for filters in split:
+                # filter.names of the inventory objects would select them by their own name
+                object_ids = self.list_objects(
+                    kind, {k: v for k, v in filters.items() if k != "filter.names"}
+                )
+                if object_ids is None:
+                    print(f"VM list of {self.api_url} may be incomplete: {filters}")
+                    continue
+                for object_id in object_ids:
+                    pending.append({**filters, f"filter.{kind}": object_id})
+        return list(vms.values())
+
     def get_vm_tags(self, vm_id):
         url = "{}/com/vmware/cis/tagging/tag-association?~action=list-attached-tags".format(
             self.api_url
@@ -78,6 +157,27 @@ class vSphereAPI:
         resp = self.post_api_data(url, req_data)
         return resp if resp else None
 
+    def get_vms_tags(self, vm_ids):
+        """Get attached tags of multiple VMs with a single request
+
+        Returns:
+            dict of vm_id -> list of tag ids or None if the request failed
+        """
+        url = "{}/com/vmware/cis/tagging/tag-association?~action=list-attached-tags-on-objects".format(
+            self.api_url
+        )
+        req_data = {
+            "object_ids": [{"type": "VirtualMachine", "id": vm_id} for vm_id in vm_ids]
+        }
+        resp = self.post_api_data(url, req_data)
+        if resp is None:
+            return None
+        # VMs without tags are not part of the response
+        vms_tags = {vm_id: [] for vm_id in vm_ids}
+        for item in resp.get("value", []):
+            vms_tags[item["object_id"]["id"]] = item["tag_ids"]
+        return vms_tags
+
     def get_tag_category(self, cat_id):
         url = "{}/com/vmware/cis/tagging/category/id:{}".format(self.api_url, cat_id)
         resp = self.get_api_data(url)
@@ -89,35 +189,205 @@ class vSphereAPI:
         return resp if resp else None
 
 
+# vCenters of one datasource share the cache file
+_cache_lock = threading.Lock()
+
+
+class TagCatalogue:
+    """Tags and categories of a vCenter, optionally persisted on disk
+    Only tags showing up in tag associations are fetched, with their categories.
+    A persisted catalogue is used for ttl seconds after its first update. Tags unknown
+    to it or with an unknown category are fetched when they show up, so new tags are
+    picked up before it expires. Renamed tags and categories are only noticed after ttl.
+    """
+
+    def __init__(self, cache_file=None, api_url=None, ttl=3600):
+        self.cache_file = cache_file
+        self.api_url = api_url
+        # tag id -> [category id, tag name]
+        self.tags = {}
+        # category id -> category name
+        self.categories = {}
+        self.loaded = 0
+        self.changed = False
+        if not cache_file or not os.path.exists(cache_file):
+            return
+        try:
+            with open(cache_file, "r") as f:
+                data = json.load(f).get(api_url, {})
+        except (OSError, ValueError) as e:
+            print(f"Could not read vSphere tag cache {cache_file}: {e}")
+            return
+        if time.time() - data.get("time", 0) < ttl:
+            self.tags = data.get("tags", {})
+            self.categories = data.get("categories", {})
+            self.loaded = data["time"]
+
+    def update(self, vsphere_api, executor, tag_ids):
+        """Fetch tags (and their categories) missing in the catalogue"""
+        if not self.loaded:
+            self.loaded = time.time()
+            self.changed = True
+        missing = [
+            tag_id
+            for tag_id in tag_ids
+            if tag_id not in self.tags or self.tags[tag_id][0] not in self.categories
+        ]
+        if missing:
+            self._fetch(vsphere_api, executor, missing)
+
+    def _fetch(self, vsphere_api, executor, tag_ids):
+        for tag_id, tag in zip(tag_ids, executor.map(vsphere_api.get_vsphere_tag, tag_ids)):
+            if tag:
+                self.tags[tag_id] = [tag["value"]["category_id"], tag["value"]["name"]]
+            else:
+                # deleted or not readable, fetched again if it shows up again
+                self.tags.pop(tag_id, None)
+        # categories are shared by many tags, fetch each one only once
+        cat_ids = {
+            cat_id for cat_id, _ in self.tags.values() if cat_id not in self.categories
+        }
+        for cat_id, category in zip(
+            cat_ids, executor.map(vsphere_api.get_tag_category, cat_ids)
+        ):
+            if category:
+                self.categories[cat_id] = category["value"]["name"]
+        self.changed = True
+
+    def resolve(self, tag_id):
+        """Returns (category name, tag name) of a tag or None if unknown"""
+        tag = self.tags.get(tag_id)
+        if tag and tag[0] in self.categories:
+            return self.categories[tag[0]], tag[1]
+        return None
+
+    def save(self):
+        if not self.cache_file or not self.changed:
+            return
+        with _cache_lock:
+            self._save()
+
+    def _save(self):
+        data = {}
+        if os.path.exists(self.cache_file):
+            try:
+                with open(self.cache_file, "r") as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                data = {}
+        data[self.api_url] = {
+            "time": self.loaded,
+            "tags": self.tags,
+            "categories": self.categories,
+        }
+        atomic_write(self.cache_file, json.dumps(data))
+
+
 class lpds_vsphere(Strategy):
     """vSphere strategy"""
 
     def source_algorithm(self, **kwargs) -> dict:
-        """Return dict of source data"""
+        """Return dict of source data
+        All vCenters listed in vcenters are read in parallel, settings not given
+        for a vCenter are taken from the datasource. Tags of VMs with the same name
+        are merged in config order, tags of later vCenters override earlier ones.
+        """
+        vcenters = kwargs.get("vcenters", None) or [{}]
+        vcenters = [{**kwargs, **vcenter} for vcenter in vcenters]
+        if len(vcenters) == 1:
+            results = [self._read_vcenter(**vcenters[0])]
+        else:
+            with ThreadPoolExecutor(max_workers=len(vcenters)) as executor:
+                results = list(
+                    executor.map(lambda vcenter: self._read_vcenter(**vcenter), vcenters)
+                )
+
+        vm_cache = {}
+        for result in results:
+            for name, tags in result.items():
+                vm_cache.setdefault(name, {}).update(tags)
+        return vm_cache
+
+    def _read_vcenter(self, **kwargs) -> dict:
+        """Returns dict VM name -> {category: tag} of one vCenter"""
         verify_ssl = kwargs.get("verify_ssl", True)
         api_url = kwargs.get("api_url", None)
         api_user = kwargs.get("api_user", None)
         api_pass = kwargs.get("api_pass", None)
+        # Number of parallel requests and VMs per tag association request
+        workers = kwargs.get("workers", 8)
+        tag_batch_size = kwargs.get("tag_batch_size", 500)
         # Authenticate on vCenter
-        vsphere_api = vSphereAPI(api_url, api_user, api_pass, verify_ssl)
+        vsphere_api = vSphereAPI(
+            api_url, api_user, api_pass, verify_ssl, workers, self.metrics
+        )
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            vms = vsphere_api.get_all_vms(
+                kwargs.get("vm_partition", ("datacenters", "hosts")),
+                kwargs.get("vm_limit", 1000),
+                executor,
+                kwargs.get("hosts", None),
+            )
+            # host_regex and shard are checked here, unselected VMs are dropped before their tags are read
+            selected = host_selector(**kwargs)
+            if selected:
+                vms = [vm for vm in vms if selected(vm["name"])]
+            vm_ids = [vm["vm"] for vm in vms]
+            batches = [
+                vm_ids[i : i + tag_batch_size]
+                for i in range(0, len(vm_ids), tag_batch_size)
+            ]
 
+            vms_tags = {}
+            for batch, batch_tags in zip(
+                batches, executor.map(vsphere_api.get_vms_tags, batches)
+            ):
+                if batch_tags is None:
+                    # Bulk action not available, fall back to one request per VM
+                    batch_tags = {
+                        vm_id: (vm_tags or {}).get("value", [])
+                        for vm_id, vm_tags in zip(
+                            batch, executor.map(vsphere_api.get_vm_tags, batch)
+                        )
+                    }
+                vms_tags.update(batch_tags)
+
+            catalogue = self._tag_catalogue(**kwargs)
+            # only the tags attached to the VMs, known tags are taken from the catalogue
+            catalogue.update(
+                vsphere_api,
+                executor,
+                list({tag for tags in vms_tags.values() for tag in tags}),
+            )
+        catalogue.save()
+
+        # VMs with the same name are merged in order of their id
         vm_cache = {}
-        tag_cache = {}
-
-        for vm in vsphere_api.get_all_vms():
-            vm_cache[vm["name"]] = {}
-            vm_tags = vsphere_api.get_vm_tags(vm["vm"])
-            for vm_tag in vm_tags["value"]:
-                if not vm_tag in tag_cache:
-                    tag = vsphere_api.get_vsphere_tag(vm_tag)
-                    tag_value = tag["value"]["name"]
-                    category = vsphere_api.get_tag_category(tag["value"]["category_id"])
-                    tag_cache[vm_tag] = (category["value"]["name"], tag_value)
-                tag_id, tag_val = tag_cache[vm_tag]
-                vm_cache[vm["name"]].update({tag_id: tag_val})
+        for vm in sorted(vms, key=lambda vm: vm["vm"]):
+            vm_tags = vm_cache.setdefault(vm["name"], {})
+            for vm_tag in vms_tags.get(vm["vm"], []):
+                tag = catalogue.resolve(vm_tag)
+                if tag:
+                    tag_id, tag_val = tag
+                    vm_tags.update({tag_id: tag_val})
 
         return vm_cache
 
+    def _tag_catalogue(self, **kwargs):
+        """Tag catalogue, persisted for tag_cache_ttl seconds with tag_cache enabled"""
+        if not kwargs.get("tag_cache", False):
+            return TagCatalogue()
+        cache_file = kwargs.get("tag_cache_file", None)
+        if not cache_file:
+            cache_file = os.environ["HOME"] + "/var/labelpicker/lpds_vsphere.cache"
+        # shards run at the same time and must not overwrite each other's cache
+        return TagCatalogue(
+            shard_path(cache_file, kwargs.get("shard", None)),
+            kwargs.get("api_url", None),
+            kwargs.get("tag_cache_ttl", 3600),
+        )
+
     def process_algorithm(self, source, **kwargs) -> dict:
         """Process source data and return dict"""
         collected_labels = {}
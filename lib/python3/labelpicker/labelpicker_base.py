@@ -7,15 +7,56 @@
 
 
 import re
-import yaml
 import sys
 import os
-import requests
 import json
-import base64
-import zlib
+import codecs
+import hashlib
+import binascii
+import marshal
+import importlib
+
+import time
+import threading
 
 from abc import ABC, abstractmethod
+from collections.abc import Mapping, MutableMapping
+from contextlib import contextmanager, nullcontext
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+
+
+class _LazyModule:
+    """Module imported on first use, so short runs do not pay for unused imports"""
+
+    def __init__(self, name):
+        self._name = name
+
+    def __getattr__(self, attr):
+        return getattr(importlib.import_module(self._name), attr)
+
+
+yaml = _LazyModule("yaml")
+requests = _LazyModule("requests")
+
+# Datasource plugins shipped with labelpicker, other plugins are found by their module name
+# in labelpicker.ds_plugins, e.g. in ~/local/lib/python3/labelpicker/ds_plugins/
+DS_PLUGINS = {
+    "lpds_csv": "labelpicker.ds_plugins.lpds_csv",
+    "lpds_hwswtree": "labelpicker.ds_plugins.lpds_hwswtree",
+    "lpds_vsphere": "labelpicker.ds_plugins.lpds_vsphere",
+}
+
+
+def load_plugin(name):
+    """Import datasource plugin and return its Strategy class, raises ImportError if not found"""
+    module = importlib.import_module(
+        DS_PLUGINS.get(name, f"labelpicker.ds_plugins.{name}")
+    )
+    try:
+        return getattr(module, name)
+    except AttributeError:
+        raise ImportError(f"{module.__name__} has no datasource class {name}")
 
 
 def _get_automation_secret(username="automation"):
@@ -41,20 +82,81 @@ class Config:
         else:
             self.config_file = config_file
 
+    # Format of the config cache, cached configs of other versions are ignored
+    cache_version = 1
+
     def get_cfg(self):
-        """Read config file"""
+        """Read config file
+        The validated config is cached in marshal format until size or mtime of the file change
+        """
         # if file ends with .yaml or .yml use yaml loader
         if self.config_file.endswith(".yaml") or self.config_file.endswith(".yml"):
-            with open(self.config_file, "r") as f:
-                return yaml.safe_load(f)
+            stat = os.stat(self.config_file)
+            key = [
+                self.cache_version,
+                os.path.abspath(self.config_file),
+                stat.st_mtime_ns,
+                stat.st_size,
+            ]
+            cfg = self._read_cache(key)
+            if cfg is None:
+                with open(self.config_file, "r") as f:
+                    cfg = yaml.safe_load(f)
+                self._validate(cfg)
+                self._write_cache(key, cfg)
+            return cfg
         else:
             print(f"Unknown config file format: {self.config_file}")
             sys.exit(1)
 
+    def _validate(self, cfg):
+        """Exit on config errors which would otherwise fail later in the run"""
+        error = None
+        if not isinstance(cfg, dict):
+            error = "not a mapping"
+        elif not isinstance(cfg.get("datasources"), dict):
+            error = "datasources missing"
+        else:
+            for name, ds_config in cfg["datasources"].items():
+                if not isinstance(ds_config, dict) or "label_prefix" not in ds_config:
+                    error = f"label_prefix of datasource {name} missing"
+                    break
+        if error:
+            print(f"Invalid config file {self.config_file}: {error}")
+            sys.exit(1)
+
+    def _cache_file(self, key):
+        digest = hashlib.sha1(key[1].encode()).hexdigest()[:16]
+        return os.path.join(
+            os.environ.get("HOME", "/tmp"), "tmp", "labelpicker", f"config-{digest}.cache"
+        )
+
+    def _read_cache(self, key):
+        try:
+            with open(self._cache_file(key), "rb") as f:
+                cached_key, cfg = marshal.load(f)
+        except (OSError, EOFError, ValueError, TypeError):
+            return None
+        return cfg if cached_key == key else None
+
+    def _write_cache(self, key, cfg):
+        """Write the cached config, readable by the owner only as it contains secrets"""
+        cache_file = self._cache_file(key)
+        try:
+            data = marshal.dumps((key, cfg))
+            os.makedirs(os.path.dirname(cache_file), mode=0o700, exist_ok=True)
+            atomic_write(cache_file, data, mode=0o600)
+        except (OSError, ValueError):
+            # values without marshal support (e.g. dates) or read-only home, run without cache
+            pass
+
     def init_cfg(self):
         """Initialize LabelPicker default configuration file"""
         init_cfg = "eJyNVNtu2zAMfc9XEMhD2iHObXsKtmJFV2zB1jWoh+6hKQxNZhyhtiRIctJi3b+PshznurUKEFjk4eFNZBsg+vdpteEZvrFfmE8Ff0ADF0rORVYa5oSS8Ez6F8wnkqtCE/xXjuAU8OIBlmisNx/1hj09GkB0BjeX8Q84n05gYm2JLTI8pPqMEg3LgVcxVM73QYw7sWQOk7kyKDKZ8AWTGdoxOEO0nFlMyLwOYNwCyH1yY8jVCo3PZsnyEtf3fQ90/8Qcs6o0HO1hBLUe4gCIYseMw0wQlgIKvnRVyFa64fFhbBOP4eLqazShKKVT5om0X5hJV8xgFKu5qz4arTcGKFRa5j5sndpksbIrZxArTduThRbCB3hfhZBog3PxeNYP17MaePnICk1dChjJCiL0XH1lq1sF2yYI6hAA01rILERDbyLgAse2uT8+tjHcrXPpwrVG/6BkBvGTdVh04Tvh7307wimY44skM6rUyVzkjto33mi9u7vOleBGWeKEn0KmamUhRkONhtFgOIKbEVAzZEqF7HShcy65oPqtIddx5/7VfCe9N6eeg8Rr0Wz4P/uTXYJTOJmlv9/9OW2YZkOYjeAyFdVQRTB7S3RHCqkNtZm7/UKuX0e3Kd80AO9bx1jorWD+MseVh9WNOEbDNOMLTOpR2uVrbt5m3ecd4ZTxB0aDuSM8ryhHrdbBQNwWngGWsV4gMfk55dQ/NINhIjaj0D6YhaVtLPbf7o7qYDPU3azXQ6l1WA9AeYukNCRbOKftuN8fDmiN0a9v0LotjEVDhvT/MVUFE7Ln8nSj1szSVmJpIeRhuhfxrUdyu0wwDOWx3Eh9LK9G/PqcmrW3JfPOadZwM2kR9F2h+14RPNax9bzHv6yT3KI="
 
+        import base64
+        import zlib
+
         # if config file does not exists, create it
         if not os.path.exists(self.config_file):
             # Decode the base64-encoded content
@@ -99,10 +201,203 @@ class bcolor:
         return f"{self.H3}{' '*4}{text}{space}{self.ENDC}"
 
 
+class Metrics:
+    """Runtime and REST request statistics of a labelpicker run
+    Statistics are grouped by scope, e.g. the name of a datasource or checkmk.
+    """
+
+    def __init__(self):
+        self.start = time.time()
+        self.scopes = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    def scope(self, name):
+        """Get statistics of a scope, created on first access"""
+        with self._lock:
+            if name not in self.scopes:
+                self.scopes[name] = MetricsScope(name)
+            return self.scopes[name]
+
+    def count(self, name, value=1):
+        """Count run wide values like number of changed hosts"""
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def merge(self, data):
+        """Add counters and scopes of another run, data as returned by to_dict"""
+        for name, value in data.get("counters", {}).items():
+            self.count(name, value)
+        for name, scope in data.get("scopes", {}).items():
+            self.scope(name).merge(scope)
+
+    def to_dict(self):
+        return {
+            "runtime": round(time.time() - self.start, 3),
+            "counters": self.counters,
+            "scopes": {name: scope.to_dict() for name, scope in self.scopes.items()},
+        }
+
+    def write_json(self, path):
+        self._write(path, json.dumps(self.to_dict(), indent=2))
+
+    def write_localcheck(self, path, service="Labelpicker"):
+        """Write result as Checkmk local check, e.g. to the agent spool directory"""
+        data = self.to_dict()
+        perfdata = [f"runtime={data['runtime']}"]
+        perfdata += [f"{name}={value}" for name, value in sorted(self.counters.items())]
+        requests_total = 0
+        for name, scope in sorted(data["scopes"].items()):
+            requests_total += scope["requests"]
+            # metric names must not contain spaces or special characters
+            name = re.sub(r"\W", "_", name)
+            for phase, seconds in scope["phases"].items():
+                perfdata.append(f"{name}_{phase}={seconds}")
+        perfdata.append(f"requests={requests_total}")
+        summary = f"Run took {data['runtime']}s, {requests_total} REST requests"
+        content = f'<<<local:sep(0)>>>\n0 "{service}" {"|".join(perfdata)} {summary}\n'
+        self._write(path, content)
+
+    def write_prometheus(self, path):
+        """Write metrics in Prometheus textfile collector format"""
+        data = self.to_dict()
+        lines = [
+            "# TYPE labelpicker_runtime_seconds gauge",
+            f"labelpicker_runtime_seconds {data['runtime']}",
+        ]
+        for name, value in sorted(self.counters.items()):
+            lines.append(f"labelpicker_{name} {value}")
+        lines.append("# TYPE labelpicker_phase_seconds gauge")
+        for name, scope in sorted(data["scopes"].items()):
+            for phase, seconds in scope["phases"].items():
+                lines.append(
+                    f'labelpicker_phase_seconds{{scope="{name}",phase="{phase}"}} {seconds}'
+                )
+        for metric in ("requests", "bytes", "retries"):
+            lines.append(f"# TYPE labelpicker_{metric}_total counter")
+            for name, scope in sorted(data["scopes"].items()):
+                lines.append(
+                    f'labelpicker_{metric}_total{{scope="{name}"}} {scope[metric]}'
+                )
+        for metric in ("hits", "misses"):
+            lines.append(f"# TYPE labelpicker_cache_{metric}_total counter")
+            for name, scope in sorted(data["scopes"].items()):
+                for cache, stats in sorted(scope["caches"].items()):
+                    lines.append(
+                        f'labelpicker_cache_{metric}_total{{scope="{name}",cache="{cache}"}} {stats[metric]}'
+                    )
+        self._write(path, "\n".join(lines) + "\n")
+
+    def _write(self, path, content):
+        atomic_write(path, content)
+
+
+class MetricsScope:
+    """Phase timings and REST request counters of one scope"""
+
+    def __init__(self, name):
+        self.name = name
+        self.phases = {}
+        self.requests = 0
+        self.bytes = 0
+        self.retries = 0
+        # memoized transforms: name -> {"hits": n, "misses": n}
+        self.caches = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name):
+        """Measure time spent in a phase, multiple calls are summed up"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def add_time(self, name, seconds):
+        with self._lock:
+            self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def count_request(self, resp, size=None):
+        """Count a request and the bytes sent and received
+        size: bytes received, needed for streamed responses
+        """
+        if size is None:
+            size = len(resp.content or b"")
+        if resp.request is not None and resp.request.body:
+            size += len(resp.request.body)
+        with self._lock:
+            self.requests += 1
+            self.bytes += size
+
+    def count_retry(self):
+        with self._lock:
+            self.retries += 1
+
+    def count_cache(self, name, hits, misses):
+        """Count hits and misses of a memoized transform, e.g. from lru_cache cache_info()"""
+        with self._lock:
+            cache = self.caches.setdefault(name, {"hits": 0, "misses": 0})
+            cache["hits"] += hits
+            cache["misses"] += misses
+
+    def merge(self, data):
+        """Add values measured in another process, data as returned by to_dict"""
+        with self._lock:
+            for name, seconds in data.get("phases", {}).items():
+                self.phases[name] = self.phases.get(name, 0.0) + seconds
+            self.requests += data.get("requests", 0)
+            self.bytes += data.get("bytes", 0)
+            self.retries += data.get("retries", 0)
+            for name, cache in data.get("caches", {}).items():
+                own = self.caches.setdefault(name, {"hits": 0, "misses": 0})
+                own["hits"] += cache["hits"]
+                own["misses"] += cache["misses"]
+
+    def to_dict(self):
+        return {
+            "phases": {name: round(sec, 3) for name, sec in self.phases.items()},
+            "requests": self.requests,
+            "bytes": self.bytes,
+            "retries": self.retries,
+            "caches": {
+                name: {
+                    **cache,
+                    "hit_rate": round(
+                        cache["hits"] / max(1, cache["hits"] + cache["misses"]), 3
+                    ),
+                }
+                for name, cache in self.caches.items()
+            },
+        }
+
+
+def timed_iter(iterable, metrics, phase):
+    """Yield items of iterable and account the time spent inside of iterable to a phase"""
+    iterator = iter(iterable)
+    elapsed = 0.0
+    try:
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                elapsed += time.perf_counter() - start
+            yield item
+    finally:
+        metrics.add_time(phase, elapsed)
+
+
 ## Strategy interface
 class Strategy(ABC):
     """Source Strategy Interface"""
 
+    # MetricsScope of the datasource, set by LableDataProcessor
+    metrics = None
+    # Run in a "thread" or a "process" with parallel_datasources, CPU bound plugins use processes
+    executor = "thread"
+
     @abstractmethod
     def source_algorithm(self) -> None:
         pass
@@ -111,13 +406,52 @@ class Strategy(ABC):
     def process_algorithm(self) -> None:
         pass
 
+    def stream_algorithm(self, **kwargs):
+        """Optional streaming mode: yield (host, labels) one host at a time
+        Plugins can override this to avoid holding the whole source data in memory,
+        by default source_algorithm and process_algorithm are used.
+        A host selection (hosts, host_regex, see host_selector) is passed in kwargs,
+        plugins should skip unselected hosts as early as possible.
+        Overrides account their time to the phases source and process (see phase and timed).
+        """
+        with self.phase("source"):
+            source_data = self.source_algorithm(**kwargs)
+        with self.phase("process"):
+            labels = self.process_algorithm(source_data, **kwargs)
+        yield from labels.items()
+
+    def phase(self, name):
+        """Measure time spent in a phase of the datasource, see MetricsScope.phase"""
+        if self.metrics is None:
+            return nullcontext()
+        return self.metrics.phase(name)
+
+    def timed(self, iterable, name):
+        """Account the time spent inside of iterable to a phase of the datasource, see timed_iter"""
+        if self.metrics is None:
+            return iterable
+        return timed_iter(iterable, self.metrics, name)
+
+    def watch_paths(self, **kwargs) -> list:
+        """Optional daemon mode: files or directories the datasource reads from
+        Changes of these paths trigger a sync, datasources without paths are polled.
+        """
+        return []
+
+    def changed_hosts(self, paths, **kwargs):
+        """Optional daemon mode: hosts affected by changes of the given paths
+        None means all hosts of the datasource have to be read again.
+        """
+        return None
+
 
 class LableDataProcessor:
     """Primary class to handle label data sourcing & processing strategies"""
 
-    def __init__(self, strategy: Strategy = None) -> None:
+    def __init__(self, strategy: Strategy = None, metrics=None) -> None:
         if strategy is not None:
             self.strategy = strategy
+            self.strategy.metrics = metrics
         else:
             # default strategy
             pass
@@ -144,17 +478,388 @@ class LableDataProcessor:
         """
         return self.strategy.process_algorithm(source_data, **kwargs)
 
+    def stream(self, **kwargs):
+        """Get and process source data host by host
+        Yields (host, labels) tuples, see process() for the structure of labels
+        """
+        return self.strategy.stream_algorithm(**kwargs)
+
+
+# kwargs of host_selector, passed to the datasources
+HOST_SELECTION = ("hosts", "host_regex", "shard")
+
+
+def host_selector(hosts=None, host_regex=None, shard=None, **kwargs):
+    """Predicate for the hosts selected by name (hosts), by regex (host_regex)
+    and by shard (index, count), a host has to match all given selections.
+    The regex has to match the beginning of the host name like host regexes in Checkmk.
+    Returns None if all hosts are selected
+    """
+    if hosts is None and not host_regex and not shard:
+        return None
+    names = None if hosts is None else set(hosts)
+    pattern = re.compile(host_regex) if host_regex else None
+
+    def selected(host):
+        if names is not None and host not in names:
+            return False
+        if shard and host_shard(host, shard[1]) != shard[0]:
+            return False
+        return pattern is None or pattern.match(host) is not None
+
+    return selected
+
+
+def host_shard(host, count):
+    """Shard (1..count) of a host, stable across processes and machines"""
+    return binascii.crc32(host.encode()) % count + 1
+
+
+def shard_path(path, shard):
+    """Per shard variant of a file written by every shard, e.g. state.json -> state.shard1of4.json"""
+    if not shard:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}.shard{shard[0]}of{shard[1]}{ext}"
+
+
+def atomic_write(path, data, mode=0o644):
+    """Replace the file path by data (str or bytes), readers see either the old or the new file
+    data is written to a uniquely named temp file next to path, so processes and threads
+    writing the same file at the same time never share a temp file, the last one wins.
+    mode: permissions of the new file
+    """
+    import tempfile
+
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_file = tempfile.mkstemp(
+        dir=directory, prefix=f".{os.path.basename(path)}.", suffix=".tmp"
+    )
+    try:
+        os.fchmod(fd, mode)
+        with open(fd, "wb" if isinstance(data, bytes) else "w") as f:
+            f.write(data)
+        os.replace(tmp_file, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_file)
+        except OSError:
+            pass
+        raise
+
+
+def iter_json_array(chunks, key):
+    """Parse a JSON object incrementally and yield the items of its array member key
+    chunks: iterable of str, members other than key are parsed and dropped
+    """
+    decoder = json.JSONDecoder()
+    chunks = iter(chunks)
+    buf = ""
+    pos = 0
+
+    def read():
+        nonlocal buf, pos
+        for chunk in chunks:
+            if chunk:
+                buf = buf[pos:] + chunk
+                pos = 0
+                return True
+        return False
+
+    def peek():
+        nonlocal pos
+        while True:
+            while pos < len(buf) and buf[pos] in " \t\r\n":
+                pos += 1
+            if pos < len(buf):
+                return buf[pos]
+            if not read():
+                raise ValueError("Incomplete JSON document")
+
+    def decode():
+        nonlocal pos
+        peek()
+        while True:
+            try:
+                value, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                if not read():
+                    raise
+                continue
+            # a number at the end of the buffer may continue in the next chunk
+            if (
+                isinstance(value, (int, float))
+                and not buf[end:].strip("0123456789.eE+-")
+                and read()
+            ):
+                continue
+            pos = end
+            return value
+
+    def expect(char):
+        nonlocal pos
+        if peek() != char:
+            raise ValueError(f"Expected {char!r} at {buf[pos:pos + 20]!r}")
+        pos += 1
+
+    expect("{")
+    while peek() != "}":
+        if buf[pos] == ",":
+            pos += 1
+        name = decode()
+        expect(":")
+        if name != key:
+            decode()
+            continue
+        expect("[")
+        while peek() != "]":
+            if buf[pos] == ",":
+                pos += 1
+            yield decode()
+        pos += 1
+
+
+class LabelStore(MutableMapping):
+    """Labels of many hosts: host -> labels
+    Label keys and values are interned, so equal strings of all hosts share one object.
+    With compact=True the labels of a host are kept as tuple of string ids
+    (key, value, key, value, ...) and decoded to a dict on access.
+    """
+
+    def __init__(self, compact=False):
+        self.compact = compact
+        self._hosts = {}
+        # string table: string -> id and id -> string
+        self._ids = {}
+        self._strings = []
+        # distinct labels -> LabelState.digest
+        self._digests = {}
+
+    def _id(self, text):
+        string_id = self._ids.get(text)
+        if string_id is None:
+            string_id = self._ids[text] = len(self._strings)
+            self._strings.append(text)
+        return string_id
+
+    def _encode(self, labels):
+        if self.compact:
+            return tuple(
+                string_id
+                for k, v in labels.items()
+                for string_id in (self._id(k), self._id(v))
+            )
+        strings = self._strings
+        return {strings[self._id(k)]: strings[self._id(v)] for k, v in labels.items()}
+
+    def __setitem__(self, host, labels):
+        self._hosts[host] = self._encode(labels)
+
+    def __getitem__(self, host):
+        labels = self._hosts[host]
+        if not self.compact:
+            return labels
+        strings = self._strings
+        return {strings[labels[i]]: strings[labels[i + 1]] for i in range(0, len(labels), 2)}
+
+    def __delitem__(self, host):
+        del self._hosts[host]
+
+    def __iter__(self):
+        return iter(self._hosts)
+
+    def __len__(self):
+        return len(self._hosts)
+
+    def __contains__(self, host):
+        return host in self._hosts
+
+    def digest(self, host):
+        """LabelState.digest of the labels of a host, computed once per distinct labels"""
+        labels = self._hosts[host]
+        key = labels if self.compact else tuple(labels.items())
+        digest = self._digests.get(key)
+        if digest is None:
+            if len(self._digests) > 2 * len(self._hosts):
+                # labels of a long running daemon change, drop digests of old labels
+                self._digests.clear()
+            digest = self._digests[key] = LabelState.digest(self[host])
+        return digest
+
+    def transform(self, func):
+        """Replace every label (key, value) of all hosts by func(key, value) in place
+        func is called once per distinct label, hosts share the results
+        """
+        converted = {}
+        for host, labels in self._hosts.items():
+            if self.compact:
+                pairs = zip(labels[0::2], labels[1::2])
+            else:
+                pairs = labels.items()
+            new_labels = {}
+            for pair in pairs:
+                label = converted.get(pair)
+                if label is None:
+                    k, v = pair
+                    if self.compact:
+                        k, v = self._strings[k], self._strings[v]
+                    label = converted[pair] = func(k, v)
+                new_labels[label[0]] = label[1]
+            self._hosts[host] = self._encode(new_labels)
+        self._digests.clear()
+
+
+class LabelUpdates(Mapping):
+    """Label definitions of all datasources per host: host -> [(datasource, label_prefix, labels), ...]
+    Backed by one LabelStore per datasource, datasources are listed in the order they were added.
+    With hosts only these hosts of the stores are included.
+    """
+
+    def __init__(self, hosts=None):
+        self.datasources = []
+        self.hosts = hosts
+
+    def add(self, strategy, label_prefix, store):
+        self.datasources.append((strategy, label_prefix, store))
+
+    def digests(self, host):
+        """LabelState digests of the label definitions of a host: datasource -> digest"""
+        return {
+            strategy: store.digest(host)
+            for strategy, _, store in self.datasources
+            if host in store
+        }
+
+    def __getitem__(self, host):
+        if self.hosts is not None and host not in self.hosts:
+            raise KeyError(host)
+        updates = [
+            (strategy, label_prefix, store[host])
+            for strategy, label_prefix, store in self.datasources
+            if host in store
+        ]
+        if not updates:
+            raise KeyError(host)
+        return updates
+
+    def __iter__(self):
+        if self.hosts is not None:
+            for host in self.hosts:
+                if any(host in store for _, _, store in self.datasources):
+                    yield host
+            return
+        seen = set()
+        for _, _, store in self.datasources:
+            for host in store:
+                if host not in seen:
+                    seen.add(host)
+                    yield host
+
+    def __len__(self):
+        if self.hosts is not None:
+            return sum(1 for _ in self)
+        return len(set().union(*(store.keys() for _, _, store in self.datasources)))
+
+
+class LabelState:
+    """Persisted state of the labels labelpicker applied to each host in the last run
+    For each host a digest of all labels after the last write and a digest of the
+    label definitions of each datasource is stored.
+    """
+
+    def __init__(self, state_file):
+        self.state_file = state_file
+        self.hosts = {}
+        self._applied = {}
+        self._digests = {}
+        # digests of the current labels computed by check
+        self._current = {}
+        self.unchanged = 0
+        if not os.path.exists(state_file):
+            return
+        try:
+            with open(state_file, "r") as f:
+                self.hosts = json.load(f).get("hosts", {})
+        except (OSError, ValueError) as e:
+            print(f"Could not read label state {state_file}: {e}")
+
+    @staticmethod
+    def digest(labels):
+        """Digest of labels, labels in a different order count as changed
+        marshal version 2 writes no references between objects, so equal labels
+        always give the same bytes and it is a lot cheaper than JSON.
+        """
+        return hashlib.sha1(marshal.dumps(labels, 2)).hexdigest()
+
+    def check(self, hostname, current_labels, ds_digests):
+        """Returns True if label definitions of all datasources and the current labels
+        of the host are unchanged since the last run"""
+        self._digests[hostname] = ds_digests
+        last = self.hosts.get(hostname)
+        if not last or last[1] != ds_digests:
+            return False
+        digest = self._current[hostname] = self.digest(current_labels)
+        if last[0] != digest:
+            return False
+        self._applied[hostname] = last
+        self.unchanged += 1
+        return True
+
+    def applied(self, hostname, labels):
+        """Remember labels of a host, which are now set on checkmk"""
+        self._applied[hostname] = [self.digest(labels), self._digests[hostname]]
+
+    def kept(self, hostname, current_labels):
+        """Remember the current labels of a host, which were correct already"""
+        digest = self._current.get(hostname) or self.digest(current_labels)
+        self._applied[hostname] = [digest, self._digests[hostname]]
+
+    def save(self, partial=False):
+        """Write state of all hosts applied in this run, all other hosts are removed
+        A partial run (selected hosts or datasources) keeps the state of the hosts it did not
+        evaluate and merges the datasource digests of the hosts it applied.
+        """
+        hosts = self._applied
+        if partial:
+            hosts = {
+                host: entry for host, entry in self.hosts.items() if host not in self._digests
+            }
+            for host, (digest, ds_digests) in self._applied.items():
+                last = self.hosts.get(host)
+                if last:
+                    # digests of datasources not read in this run are still valid
+                    ds_digests = {**last[1], **ds_digests}
+                hosts[host] = [digest, ds_digests]
+        atomic_write(self.state_file, json.dumps({"hosts": hosts}))
+
 
 class CMKInstance:
     """Interact with checkmk instance"""
 
-    def __init__(self, url=None, username="automation", password=None):
+    # Status codes of temporary errors, requests are retried with exponential backoff
+    retry_status = (429, 500, 502, 503, 504)
+
+    def __init__(
+        self,
+        url=None,
+        username="automation",
+        password=None,
+        metrics=None,
+        workers=4,
+        retries=3,
+        backoff=0.5,
+    ):
         """Initialize a REST-API instance. URL, User and Secret can be automatically taken from local site if running as site user.
 
         Args:
             site_url: the site URL
             api_user: username of automation user account
             api_secret: automation secret
+            metrics: MetricsScope to count REST requests
+            workers: number of parallel requests for writing labels
+            retries: max. retries of a request on temporary errors and etag conflicts
+            backoff: seconds to wait before the first retry, doubled on every retry
 
         Returns:
             instance of CMKRESTAPI
@@ -184,7 +889,18 @@ class CMKInstance:
             "Content-Type": "application/json",
         }
 
+        self.username = username
+        self.metrics = metrics or MetricsScope("checkmk")
+        self.workers = max(1, workers)
+        self.retries = retries
+        self.backoff = backoff
         self._session = requests.session()
+        # one connection per worker, otherwise parallel requests wait for the pool
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=1, pool_maxsize=max(10, self.workers)
+        )
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
         self._session.headers["Authorization"] = f"Bearer {username} {secret}"
         self._session.headers["Accept"] = "application/json"
 
@@ -196,22 +912,51 @@ class CMKInstance:
             print(f"JSONDecodeError for data: {data}")
         return data, resp
 
-    def _request_url(self, method, endpoint, data={}, etag=None):
-        headers = self.headers
+    def _request_url(self, method, endpoint, data={}, etag=None, stream=False):
+        # copy headers, otherwise an etag would stick to all following requests
+        headers = self.headers.copy()
         if etag is not None:
             headers["If-Match"] = etag
 
         url = f"{self._api_url}/{endpoint}"
         request_func = getattr(self._session, method.lower())
+        # GET parameters are query parameters, all others are sent as JSON body
+        if method == "GET":
+            kwargs = {"params": data}
+        else:
+            kwargs = {"json": data}
 
-        return self._trans_resp(
-            request_func(
-                url,
-                json=data,
-                headers=headers,
-                allow_redirects=False,
-            )
-        )
+        for attempt in range(self.retries + 1):
+            try:
+                resp = request_func(
+                    url,
+                    headers=headers,
+                    allow_redirects=False,
+                    stream=stream,
+                    **kwargs,
+                )
+            except requests.exceptions.ConnectionError:
+                if attempt == self.retries:
+                    raise
+                self._wait_retry(attempt)
+                continue
+            if resp.status_code in self.retry_status and attempt < self.retries:
+                self.metrics.count_request(resp)
+                self._wait_retry(attempt, resp)
+                continue
+            if stream:
+                # counted by the caller after the response was read
+                return resp
+            self.metrics.count_request(resp)
+            return self._trans_resp(resp)
+
+    def _wait_retry(self, attempt, resp=None):
+        """Wait before the next retry, honor Retry-After header of the response"""
+        self.metrics.count_retry()
+        delay = self.backoff * 2**attempt
+        if resp is not None and resp.headers.get("Retry-After", "").isdigit():
+            delay = int(resp.headers["Retry-After"])
+        time.sleep(min(delay, 60))
 
     def _get_url(self, endpoint, data={}):
         return self._request_url("GET", endpoint, data)
@@ -232,7 +977,6 @@ class CMKInstance:
         postdata = {"redirect": False, "sites": sites, "force_foreign_changes": force}
         data, resp = self._post_url(
             "domain-types/activation_run/actions/activate-changes/invoke",
-            etag="*",
             data=postdata,
             etag="*",
         )
@@ -241,19 +985,38 @@ class CMKInstance:
         else:
             resp.raise_for_status()
 
-    def get_all_hosts(self, effective_attr=False, attributes=True):
+    def get_all_hosts(
+        self,
+        effective_attr=False,
+        attributes=True,
+        fields=None,
+        hostnames=None,
+        effective_fields=None,
+    ):
         """Gets all hosts from the CheckMK configuration.
 
         Args:
             effective_attr: Show all effective attributes, which affect this host, not just the attributes which were set on this host specifically. This includes all attributes of all of this host's parent folders.
             attributes: If False do not fetch hosts' data
+            fields: Only keep these attributes, e.g. ["labels", "site"]. The collection is parsed while it is received, so the complete document is never held in memory.
+            hostnames: With fields only keep the hosts in this set
+            effective_fields: With fields fetch the effective attributes and only keep these of them, e.g. ["site"]
 
         Returns:
             hosts: Dictionary of host data or dict of hostname -> URL depending on attributes parameter
         """
+        if fields is not None and effective_fields is not None:
+            effective_attr = True
+        params = {"effective_attributes": "true" if effective_attr else "false"}
+        if fields is not None:
+            return self._stream_all_hosts(
+                params,
+                {"attributes": fields, "effective_attributes": effective_fields or fields},
+                hostnames,
+            )
         data, resp = self._get_url(
             f"domain-types/host_config/collections/all",
-            data={"effective_attributes": "true" if effective_attr else "false"},
+            data=params,
         )
         if resp.status_code != 200:
             resp.raise_for_status()
@@ -266,6 +1029,134 @@ class CMKInstance:
                 pass
         return hosts
 
+    def _stream_all_hosts(self, params, fields, hostnames=None):
+        """Parse the host collection while it is received and keep only the given attributes
+        (and hosts if hostnames is given), fields: extensions key -> list of attributes"""
+        endpoint = "domain-types/host_config/collections/all"
+        # links make up a large part of the collection, skip them if supported by the API
+        resp = self._request_url(
+            "GET", endpoint, {**params, "include_links": "false"}, stream=True
+        )
+        if resp.status_code == 400:
+            self.metrics.count_request(resp)
+            resp = self._request_url("GET", endpoint, params, stream=True)
+        if resp.status_code != 200:
+            self.metrics.count_request(resp)
+            resp.raise_for_status()
+
+        received = 0
+        decoder = codecs.getincrementaldecoder("utf-8")()
+
+        def chunks():
+            nonlocal received
+            for chunk in resp.iter_content(chunk_size=65536):
+                received += len(chunk)
+                yield decoder.decode(chunk)
+            yield decoder.decode(b"", final=True)
+
+        hosts = {}
+        try:
+            for hinfo_dict in iter_json_array(chunks(), "value"):
+                try:
+                    if hostnames is not None and hinfo_dict["id"] not in hostnames:
+                        continue
+                    extensions = hinfo_dict["extensions"]
+                    host = {}
+                    for key, keep in fields.items():
+                        attributes = extensions.get(key)
+                        if attributes is not None:
+                            host[key] = {
+                                field: attributes[field]
+                                for field in keep
+                                if field in attributes
+                            }
+                    hosts[hinfo_dict["id"]] = host
+                except (KeyError, TypeError):
+                    pass
+        finally:
+            resp.close()
+            self.metrics.count_request(resp, received)
+        return hosts
+
+    def get_pending_changes(self):
+        """Gets the pending changes of all sites
+
+        Returns:
+            changes: List of pending changes (user_id, action_name, text, ...)
+        """
+        data, resp = self._get_url(
+            "domain-types/activation_run/collections/pending_changes"
+        )
+        if resp.status_code != 200:
+            resp.raise_for_status()
+        return [change.get("extensions", change) for change in data.get("value", [])]
+
+    def host_sites(self, hostnames, hosts):
+        """Sites the given hosts are monitored on
+
+        Args:
+            hostnames: iterable of cmk hostnames
+            hosts: host data as returned by get_all_hosts, the site is taken from the effective
+                attributes (inherited from the folders) if present, otherwise from the attributes.
+                Hosts without both are fetched with their effective attributes.
+
+        Returns:
+            sites: set of site ids or None if the site of a host is unknown
+        """
+        sites = set()
+        inherited = []
+        for hostname in hostnames:
+            data = hosts.get(hostname, {})
+            site = (data.get("effective_attributes") or {}).get("site") or data.get(
+                "attributes", {}
+            ).get("site")
+            if site:
+                sites.add(site)
+            else:
+                inherited.append(hostname)
+        for hostname, data in self.get_hosts(inherited, effective_attr=True).items():
+            site = data.get("effective_attributes", {}).get("site") or data.get(
+                "attributes", {}
+            ).get("site")
+            if not site:
+                return None
+            sites.add(site)
+        return sites
+
+    def get_hosts(self, hostnames, effective_attr=False):
+        """Gets the given hosts in parallel, unknown hosts are skipped
+
+        Args:
+            hostnames: iterable of cmk hostnames
+            effective_attr: Include the effective attributes (inherited from the folders)
+
+        Returns:
+            hosts: Dictionary of hostname -> host data (extensions)
+        """
+
+        def fetch(hostname):
+            data, resp = self._get_url(
+                f"objects/host_config/{hostname}",
+                data={"effective_attributes": "true" if effective_attr else "false"},
+            )
+            if resp.status_code == 404:
+                return hostname, None
+            if resp.status_code != 200:
+                resp.raise_for_status()
+            return hostname, data.get("extensions", {})
+
+        hostnames = list(hostnames)
+        if not hostnames:
+            return {}
+        with ThreadPoolExecutor(
+            max_workers=min(self.workers, len(hostnames))
+        ) as executor:
+            return {
+                hostname: data
+                for hostname, data in executor.map(fetch, hostnames)
+                if data is not None
+            }
+
     def get_host(self, hostname):
         """Get current host configuration
 
@@ -314,16 +1205,22 @@ class CMKInstance:
         elif unset_attr:
             data = {"remove_attributes": unset_attr}
 
-        if not etag:
-            etag = self.get_etag(hostname)
-        data, resp = self._put_url(
-            f"objects/host_config/{hostname}",
-            etag,
-            data=data,
-        )
-        if resp.status_code == 200:
-            return data, etag
-        resp.raise_for_status()
+        for attempt in range(self.retries + 1):
+            if not etag:
+                etag = self.get_etag(hostname)
+            resp_data, resp = self._put_url(
+                f"objects/host_config/{hostname}",
+                etag,
+                data=data,
+            )
+            if resp.status_code == 200:
+                return resp_data, etag
+            if resp.status_code == 412 and attempt < self.retries:
+                # Host was changed since the etag was fetched, fetch it again
+                self.metrics.count_retry()
+                etag = None
+                continue
+            resp.raise_for_status()
 
     def host_exists(self, hostname):
         """Check if host exists"""
@@ -344,6 +1241,98 @@ class CMKInstance:
         """Set host labels on checkmk"""
         self.edit_host(hostname, update_attr={"labels": labels})
 
+    def bulk_edit_hosts(self, entries, chunk_size=500):
+        """Edit multiple hosts in the CheckMK configuration with the bulk-update action.
+
+        Args:
+            entries: list of dicts with host_name and one of attributes, update_attributes or remove_attributes
+            chunk_size: max. number of hosts sent with one request
+
+        Returns:
+            failed: dict of hostname -> error message for hosts which could not be updated
+        """
+        chunks = [entries[i : i + chunk_size] for i in range(0, len(entries), chunk_size)]
+        failed = {}
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for chunk_failed in executor.map(self._bulk_edit_chunk, chunks):
+                failed.update(chunk_failed)
+        return failed
+
+    def _bulk_edit_chunk(self, chunk):
+        """Send one chunk of the bulk-update action, returns dict of failed hosts"""
+        try:
+            data, resp = self._put_url(
+                "domain-types/host_config/actions/bulk-update/invoke",
+                None,
+                data={"entries": chunk},
+            )
+        except requests.exceptions.RequestException as e:
+            return {entry["host_name"]: str(e) for entry in chunk}
+        if resp.status_code == 200:
+            return {}
+        return self._bulk_failed_hosts(chunk, data, resp)
+
+    def _bulk_failed_hosts(self, chunk, data, resp):
+        """Extract failed hosts from a bulk action error response.
+        If the response does not name the failed hosts, the whole chunk is considered failed.
+        """
+        try:
+            failed_hosts = data["ext"]["failed_hosts"]
+            if failed_hosts:
+                return {host: str(msg) for host, msg in failed_hosts.items()}
+        except (KeyError, TypeError, AttributeError):
+            pass
+        try:
+            msg = data.get("detail") or data.get("title")
+        except AttributeError:
+            msg = None
+        msg = msg or f"HTTP {resp.status_code}"
+        return {entry["host_name"]: msg for entry in chunk}
+
+    def bulk_set_hostlabels(self, host_labels, chunk_size=500):
+        """Set host labels for multiple hosts on checkmk
+
+        Args:
+            host_labels: dict of hostname -> labels
+            chunk_size: max. number of hosts sent with one request
+
+        Returns:
+            failed: dict of hostname -> error message
+        """
+        entries = [
+            {"host_name": host, "update_attributes": {"labels": labels}}
+            for host, labels in host_labels.items()
+        ]
+        return self.bulk_edit_hosts(entries, chunk_size=chunk_size)
+
+    def write_hostlabels(self, host_labels, chunk_size=500):
+        """Set host labels for multiple hosts with parallel requests
+        Errors are collected instead of raised, so one failing host does not stop the others.
+
+        Args:
+            host_labels: dict of hostname -> labels
+            chunk_size: hosts per bulk-update request, 0 sends one edit request per host
+
+        Returns:
+            failed: dict of hostname -> error message
+        """
+        if chunk_size:
+            return self.bulk_set_hostlabels(host_labels, chunk_size=chunk_size)
+
+        def set_labels(item):
+            try:
+                self.set_hostlabels(*item)
+            except requests.exceptions.RequestException as e:
+                return item[0], str(e)
+            return item[0], None
+
+        failed = {}
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for host, error in executor.map(set_labels, host_labels.items()):
+                if error:
+                    failed[host] = error
+        return failed
+
     def update_labels(
         self, orig_labels, labels, label_prefix="hwsw/", enforce_cleanup=False
     ) -> dict:
@@ -365,15 +1354,113 @@ class CMKInstance:
 
 
 def case_conversion(label_definitions, params, prefix) -> dict:
+    """Case conversion of dict host -> labels
+    Not used by labelpicker itself (see LabelConverter), kept as public API for scripts.
+    """
+    converter = LabelConverter(params, prefix)
     converted = {}
     for host, data in label_definitions.items():
-        converted[host] = {}
-        for k, v in data.items():
-            if "label" in params:
-                k = k.split(prefix)[1]
-                k = getattr(k, params["label"])()
-            if "value" in params:
-                v = getattr(v, params["value"])()
-
-            converted[host].update({f"{prefix}{k}": v})
+        converted[host] = converter.convert(data)
     return converted
+
+
+def convert_label(k, v, params, prefix):
+    """Case conversion of a single label, returns (key, value)"""
+    if "label" in params:
+        k = k.split(prefix)[1]
+        k = getattr(k, params["label"])()
+    if "value" in params:
+        v = getattr(v, params["value"])()
+    return f"{prefix}{k}", v
+
+
+class LabelConverter:
+    """Case conversion of labels, memoized per label in a cache of cache_size labels
+    Most labels repeat across hosts, so every distinct label is converted once per run.
+    """
+
+    def __init__(self, params, prefix, cache_size=65536):
+        self.convert_label = lru_cache(maxsize=cache_size)(
+            lambda k, v: convert_label(k, v, params, prefix)
+        )
+
+    def convert(self, labels) -> dict:
+        """Case conversion of the labels of a single host"""
+        convert_label = self.convert_label
+        return dict(convert_label(k, v) for k, v in labels.items())
+
+    def cache_info(self):
+        return self.convert_label.cache_info()
+
+
+@lru_cache(maxsize=None)
+def _prefix_matcher(label_prefix, ignore_case):
+    """Match function for label keys with the given prefix, compiled once per prefix"""
+    return re.compile(re.escape(label_prefix), re.IGNORECASE if ignore_case else 0).match
+
+
+class LabelDiff:
+    """Changes of the labels of a host
+
+    Attributes:
+        added: dict of new labels
+        changed: dict of key -> (old value, new value)
+        removed: dict of removed labels
+    """
+
+    __slots__ = ("added", "changed", "removed")
+
+    def __init__(self, added=None, changed=None, removed=None):
+        self.added = added or {}
+        self.changed = changed or {}
+        self.removed = removed or {}
+
+    def __bool__(self):
+        return bool(self.added or self.changed or self.removed)
+
+    def apply(self, labels) -> dict:
+        """Returns labels with the changes applied"""
+        updated_labels = {k: v for k, v in labels.items() if k not in self.removed}
+        updated_labels.update(self.added)
+        updated_labels.update({k: new for k, (_, new) in self.changed.items()})
+        return updated_labels
+
+    def to_dict(self):
+        return {
+            "added": self.added,
+            "changed": {k: list(values) for k, values in self.changed.items()},
+            "removed": self.removed,
+        }
+
+
+def diff_labels(current_labels, updates, enforce_cleanup=False) -> LabelDiff:
+    """Changes of the current labels of a host caused by the label definitions of all datasources
+    The result is the same as applying update_labels for every datasource in order:
+    labels starting with the label prefix of a datasource (case-insensitive with enforce_cleanup)
+    are replaced by the labels of that datasource.
+
+    Args:
+        current_labels: labels of the host in Checkmk
+        updates: list of (label_prefix, labels) in datasource order
+    """
+    # labels set by the datasources, later datasources replace labels matching their prefix
+    defined = {}
+    matchers = []
+    for label_prefix, labels in updates:
+        match = _prefix_matcher(label_prefix, enforce_cleanup)
+        matchers.append(match)
+        if defined:
+            defined = {k: v for k, v in defined.items() if not match(k)}
+        defined.update(labels)
+
+    diff = LabelDiff()
+    for k, v in current_labels.items():
+        if k in defined:
+            if defined[k] != v:
+                diff.changed[k] = (v, defined[k])
+        elif any(match(k) for match in matchers):
+            diff.removed[k] = v
+    for k, v in defined.items():
+        if k not in current_labels:
+            diff.added[k] = v
+    return diff
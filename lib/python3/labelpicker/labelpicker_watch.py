@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8; py-indent-offset: 4 -*-
+
+# SPDX-FileCopyrightText: © 2023 PL Automation Monitoring GmbH <pl@automation-monitoring.com>
+# SPDX-License-Identifier: GPL-3.0-or-later
+# This file is part of the Checkmk Labelpicker project (https://labelpicker.mk)
+
+
+import os
+import time
+import struct
+import select
+import ctypes
+import ctypes.util
+
+# inotify event masks, see inotify(7)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (
+    IN_CLOSE_WRITE
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+    | IN_DELETE_SELF
+    | IN_MOVE_SELF
+)
+EVENT_HEADER = struct.Struct("iIII")
+
+
+class FileWatcher:
+    """Watch files and directories for changes
+    Uses inotify where available and falls back to polling mtime and size.
+    Files are watched via their parent directory, so files replaced by a rename
+    (as Checkmk does for inventory files) are still noticed.
+    """
+
+    def __init__(self, poll_interval=10, use_inotify=True):
+        self.poll_interval = poll_interval
+        # path -> watched directory
+        self.paths = {}
+        self.fd = None
+        self.wds = {}
+        self.snapshot = {}
+        if use_inotify:
+            self._init_inotify()
+
+    def _init_inotify(self):
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+            fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        except (OSError, AttributeError):
+            return
+        if fd < 0:
+            return
+        self.libc = libc
+        self.fd = fd
+
+    @property
+    def mode(self):
+        return "inotify" if self.fd is not None else "polling"
+
+    def add(self, path):
+        """Watch path, a file or a directory (changes of its entries are reported)"""
+        path = os.path.abspath(path)
+        directory = path if os.path.isdir(path) else os.path.dirname(path)
+        self.paths[path] = directory
+        if self.fd is not None and directory not in self.wds.values():
+            wd = self.libc.inotify_add_watch(
+                self.fd, os.fsencode(directory), WATCH_MASK
+            )
+            if wd < 0:
+                print(
+                    f"Could not watch {directory}: {os.strerror(ctypes.get_errno())}, polling"
+                )
+                self._stop_inotify()
+            else:
+                self.wds[wd] = directory
+        self.snapshot.update(self._scan(path))
+
+    def wait(self, timeout):
+        """Wait up to timeout seconds for changes
+        Returns set of changed paths, a watched directory itself is returned
+        if it has to be read again completely (e.g. event queue overflow)
+        """
+        if self.fd is None:
+            return self._poll(timeout)
+        ready, _, _ = select.select([self.fd], [], [], max(0, timeout))
+        if not ready:
+            return set()
+        try:
+            buf = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return set()
+        changed = set()
+        offset = 0
+        while offset < len(buf):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(buf, offset)
+            offset += EVENT_HEADER.size
+            name = buf[offset : offset + length].rstrip(b"\0")
+            offset += length
+            directory = self.wds.get(wd)
+            if mask & IN_Q_OVERFLOW:
+                changed.update(self.wds.values())
+            elif directory is None:
+                continue
+            elif name:
+                changed.add(os.path.join(directory, os.fsdecode(name)))
+            else:
+                changed.add(directory)
+        return self._relevant(changed)
+
+    def _relevant(self, changed):
+        """Drop changes of directory entries which are not watched"""
+        relevant = set()
+        for path in changed:
+            if path in self.paths or os.path.dirname(path) in self.paths:
+                relevant.add(path)
+            elif path in self.wds.values():
+                # watched directory itself changed, report all files watched in it
+                relevant.update(p for p, d in self.paths.items() if d == path)
+        return relevant
+
+    def _scan(self, path):
+        """Returns dict path -> (mtime, size) of path and its directory entries"""
+        result = {}
+        try:
+            if os.path.isdir(path):
+                for entry in os.scandir(path):
+                    stat = entry.stat()
+                    result[entry.path] = (stat.st_mtime_ns, stat.st_size)
+            else:
+                stat = os.stat(path)
+                result[path] = (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            pass
+        return result
+
+    def _poll(self, timeout):
+        time.sleep(max(0, min(timeout, self.poll_interval)))
+        snapshot = {}
+        for path in self.paths:
+            snapshot.update(self._scan(path))
+        changed = {
+            path
+            for path in set(snapshot) | set(self.snapshot)
+            if snapshot.get(path) != self.snapshot.get(path)
+        }
+        self.snapshot = snapshot
+        return changed
+
+    def _stop_inotify(self):
+        os.close(self.fd)
+        self.fd = None
+        self.wds = {}
+
+    def close(self):
+        if self.fd is not None:
+            self._stop_inotify()
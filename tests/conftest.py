@@ -0,0 +1,14 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8; py-indent-offset: 4 -*-
+
+# SPDX-FileCopyrightText: © 2023 PL Automation Monitoring GmbH <pl@automation-monitoring.com>
+# SPDX-License-Identifier: GPL-3.0-or-later
+# This file is part of the Checkmk Labelpicker project (https://labelpicker.mk)
+
+import os
+import sys
+
+# labelpicker is installed to ~/local/lib/python3 of a site, import it from the source tree
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.dirname(__file__)), "lib", "python3")
+)
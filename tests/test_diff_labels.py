@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8; py-indent-offset: 4 -*-
+
+# SPDX-FileCopyrightText: © 2023 PL Automation Monitoring GmbH <pl@automation-monitoring.com>
+# SPDX-License-Identifier: GPL-3.0-or-later
+# This file is part of the Checkmk Labelpicker project (https://labelpicker.mk)
+
+import random
+
+import labelpicker.labelpicker_base as lpb
+
+
+def test_diff_labels_matches_update_labels():
+    """diff_labels applies the datasources like update_labels one after the other"""
+    wato = lpb.CMKInstance(url="http://localhost", password="secret")
+    rnd = random.Random(3)
+    keys = ["a/x", "A/x", "a/y", "ab/z", "b/x", "B/y", "c", "a", "b/a/x", "x"]
+    values = ["1", "2"]
+    for n in range(5000):
+        current = {k: rnd.choice(values) for k in rnd.sample(keys, rnd.randint(0, 6))}
+        updates = [
+            (
+                rnd.choice(["a", "A", "b", "a/", "ab"]),
+                {k: rnd.choice(values) for k in rnd.sample(keys, rnd.randint(0, 4))},
+            )
+            for _ in range(rnd.randint(1, 3))
+        ]
+        cleanup = rnd.random() < 0.5
+        expected = current
+        for prefix, labels in updates:
+            expected = wato.update_labels(expected, labels, prefix, cleanup)
+        diff = lpb.diff_labels(current, updates, cleanup)
+        assert diff.apply(current) == expected, n
+        assert bool(diff) == (expected != current), n
+
+
+def test_diff_labels_changes():
+    diff = lpb.diff_labels(
+        {"hw/os": "linux", "hw/old": "x", "other": "y"},
+        [("hw/", {"hw/os": "windows", "hw/new": "z"})],
+    )
+    assert diff.to_dict() == {
+        "added": {"hw/new": "z"},
+        "changed": {"hw/os": ["linux", "windows"]},
+        "removed": {"hw/old": "x"},
+    }
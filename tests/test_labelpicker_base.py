@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8; py-indent-offset: 4 -*-
+
+# SPDX-FileCopyrightText: © 2023 PL Automation Monitoring GmbH <pl@automation-monitoring.com>
+# SPDX-License-Identifier: GPL-3.0-or-later
+# This file is part of the Checkmk Labelpicker project (https://labelpicker.mk)
+
+import json
+import os
+import random
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+
+import pytest
+
+import labelpicker.labelpicker_base as lpb
+
+# strings with escapes and non ascii characters, numbers and literals of all kinds
+VALUES = [
+    {"id": "host1", "extensions": {"attributes": {"labels": {"a/b": "c"}, "site": "s1"}}},
+    "ä\"\\u00e9 ]},[{",
+    "",
+    123456789,
+    -42,
+    0,
+    3.25e-10,
+    -1.5e300,
+    True,
+    False,
+    None,
+    [],
+    {},
+    [[1, "2"], {"value": [3]}],
+]
+
+DOCUMENT = {
+    # members before value, also containing arrays named value
+    "links": [{"rel": "self", "value": [1, 2], "href": "http://x/value"}],
+    "id": "host",
+    "value": VALUES,
+    "extensions": {"value": []},
+}
+
+
+def chunked(text, cuts):
+    """Split text at the given positions"""
+    cuts = sorted(cuts)
+    return [text[a:b] for a, b in zip([0] + cuts, cuts + [len(text)])]
+
+
+@pytest.mark.parametrize("ensure_ascii", [True, False])
+@pytest.mark.parametrize("indent", [None, 1])
+def test_iter_json_array_every_boundary(indent, ensure_ascii):
+    text = json.dumps(DOCUMENT, indent=indent, ensure_ascii=ensure_ascii)
+    for cut in range(1, len(text)):
+        assert list(lpb.iter_json_array(chunked(text, [cut]), "value")) == VALUES, cut
+
+
+def test_iter_json_array_single_characters():
+    text = json.dumps(DOCUMENT)
+    assert list(lpb.iter_json_array(list(text), "value")) == VALUES
+
+
+def test_iter_json_array_random_chunks():
+    rnd = random.Random(5)
+    for n in range(200):
+        value = [
+            {
+                "id": f"h{i}",
+                "n": rnd.random() * 10 ** rnd.randint(0, 8),
+                "i": rnd.randint(-(10**9), 10**9),
+                "e": {"s": "ä\"\\u00e9 ]}", "t": True, "f": False, "z": None},
+            }
+            for i in range(rnd.randint(0, 20))
+        ] + [1.5e10, -3]
+        doc = {"links": [{"value": [1, 2]}], "id": "host", "value": value, "x": 1}
+        text = json.dumps(doc, indent=rnd.choice([None, 1]))
+        cuts = rnd.sample(range(1, len(text)), min(len(text) - 1, rnd.randint(0, 50)))
+        assert list(lpb.iter_json_array(chunked(text, cuts), "value")) == value, n
+
+
+def test_iter_json_array_value_last():
+    text = json.dumps({"id": "host", "extensions": {}, "value": [1, "2"]})
+    assert list(lpb.iter_json_array(chunked(text, [3, 20]), "value")) == [1, "2"]
+
+
+def test_iter_json_array_missing_key():
+    text = json.dumps({"id": "host", "extensions": {}})
+    assert list(lpb.iter_json_array([text], "value")) == []
+
+
+def test_iter_json_array_incomplete():
+    text = json.dumps(DOCUMENT)
+    with pytest.raises(ValueError):
+        list(lpb.iter_json_array([text[: len(text) // 2]], "value"))
+
+
+def test_label_state_partial_save(tmp_path):
+    """A run of selected hosts or datasources keeps the state of all other hosts"""
+    state_file = str(tmp_path / "state.json")
+    state = lpb.LabelState(state_file)
+    for host in ("h1", "h2", "h3"):
+        state.check(host, {}, {"hw": "1", "csv": "1"})
+        state.applied(host, {"l": host})
+    state.save()
+
+    state = lpb.LabelState(state_file)
+    # h1 applied with the csv datasource only, h2 evaluated but not applied
+    state.check("h1", {}, {"csv": "2"})
+    state.applied("h1", {"l": "new"})
+    state.check("h2", {}, {"csv": "2"})
+    state.save(partial=True)
+
+    hosts = lpb.LabelState(state_file).hosts
+    assert hosts["h1"] == [lpb.LabelState.digest({"l": "new"}), {"hw": "1", "csv": "2"}]
+    assert "h2" not in hosts
+    assert hosts["h3"] == [lpb.LabelState.digest({"l": "h3"}), {"hw": "1", "csv": "1"}]
+
+    state = lpb.LabelState(state_file)
+    state.check("h1", {}, {"csv": "2"})
+    state.applied("h1", {"l": "new"})
+    state.save()
+    assert list(lpb.LabelState(state_file).hosts) == ["h1"]
+
+
+def test_atomic_write(tmp_path):
+    path = tmp_path / "dir" / "file.json"
+    lpb.atomic_write(str(path), "text")
+    assert path.read_text() == "text"
+    lpb.atomic_write(str(path), b"bytes", mode=0o600)
+    assert path.read_bytes() == b"bytes"
+    assert path.stat().st_mode & 0o777 == 0o600
+    assert os.listdir(path.parent) == ["file.json"]
+
+
+def _write_many(path, index):
+    for n in range(50):
+        lpb.atomic_write(path, json.dumps({"writer": index, "n": n, "data": "x" * 10000}))
+
+
+def test_atomic_write_concurrent(tmp_path):
+    """Processes writing the same file at the same time, e.g. shards"""
+    path = str(tmp_path / "file.json")
+    with ProcessPoolExecutor(max_workers=4) as executor:
+        list(executor.map(_write_many, [path] * 4, range(4)))
+    with open(path) as f:
+        assert json.load(f)["n"] == 49
+    assert os.listdir(tmp_path) == ["file.json"]
+
+
+def test_host_shard():
+    """Shards are stable across processes and Python versions, unlike hash()"""
+    assert lpb.host_shard("host1", 4) == 2
+    assert lpb.host_shard("srv-äöü", 3) == zlib.crc32("srv-äöü".encode()) % 3 + 1
+    assert lpb.host_shard("host1", 1) == 1
+    shards = {lpb.host_shard(f"host{i}", 4) for i in range(1000)}
+    assert shards == {1, 2, 3, 4}
+
+
+def test_host_selector():
+    assert lpb.host_selector() is None
+    assert lpb.host_selector(host_regex="", shard=None) is None
+    hosts = [f"host{i}" for i in range(20)] + ["other1"]
+
+    def select(**selection):
+        selected = lpb.host_selector(**selection)
+        return [host for host in hosts if selected(host)]
+
+    assert select(hosts=["host1", "other1", "unknown"]) == ["host1", "other1"]
+    # the regex has to match the beginning of the host name
+    assert select(host_regex="1") == []
+    assert select(host_regex="host1") == ["host1"] + [f"host{i}" for i in range(10, 20)]
+    assert select(hosts=["host1", "host2", "other1"], host_regex="host") == [
+        "host1",
+        "host2",
+    ]
+    assert select(hosts=[]) == []
+
+
+def test_host_selector_shards():
+    """The shards of a selection do not overlap and cover all selected hosts"""
+    hosts = [f"host{i}" for i in range(200)]
+    selected = []
+    for index in (1, 2, 3):
+        selector = lpb.host_selector(host_regex="host1", shard=(index, 3))
+        selected.append([host for host in hosts if selector(host)])
+    assert all(selected)
+    assert sorted(sum(selected, [])) == sorted(h for h in hosts if h.startswith("host1"))
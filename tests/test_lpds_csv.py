@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8; py-indent-offset: 4 -*-
+
+# SPDX-FileCopyrightText: © 2023 PL Automation Monitoring GmbH <pl@automation-monitoring.com>
+# SPDX-License-Identifier: GPL-3.0-or-later
+# This file is part of the Checkmk Labelpicker project (https://labelpicker.mk)
+
+import pytest
+
+from labelpicker.ds_plugins.lpds_csv import _merge_labels, _parse_row, lpds_csv
+
+
+def test_parse_row():
+    assert _parse_row(["host1", " Owner : IT ,Room:305"]) == (
+        "host1",
+        {"Owner": "IT", "Room": "305"},
+    )
+
+
+def test_parse_row_value_with_colons():
+    assert _parse_row(["host1", "url:http://x:80/a"]) == (
+        "host1",
+        {"url": "http://x:80/a"},
+    )
+
+
+@pytest.mark.parametrize(
+    "row",
+    [
+        ["host1"],
+        ["", "a:b"],
+        ["host1", "a:b,c"],
+        ["host1", "a:b,:c"],
+        ["host1", ""],
+    ],
+)
+def test_parse_row_invalid(row):
+    assert _parse_row(row) is None
+
+
+@pytest.mark.parametrize(
+    "duplicates, expected",
+    [
+        ("replace", {"b": "3", "c": "4"}),
+        ("merge", {"a": "1", "b": "3", "c": "4"}),
+        ("first", {"a": "1", "b": "2"}),
+    ],
+)
+def test_merge_labels(duplicates, expected):
+    collected = {}
+    _merge_labels(collected, "host1", {"a": "1", "b": "2"}, duplicates)
+    _merge_labels(collected, "host1", {"b": "3", "c": "4"}, duplicates)
+    _merge_labels(collected, "host2", {"d": "5"}, duplicates)
+    assert collected == {"host1": expected, "host2": {"d": "5"}}
+
+
+def test_source_algorithm(tmp_path, capsys):
+    """Files are combined in config order, headers and invalid rows are skipped"""
+    first = tmp_path / "first.csv"
+    first.write_text("host;labels\nhost1;a:1,b:2\nhost2;invalid\n\nhost3;c:3\n")
+    second = tmp_path / "second.csv"
+    second.write_text("host;labels\nhost1;b:3\n")
+    source = lpds_csv().source_algorithm(
+        csv_files=[str(first), str(second), str(tmp_path / "missing.csv")],
+        duplicate_hosts="merge",
+    )
+    assert source == {"host1": {"a": "1", "b": "3"}, "host3": {"c": "3"}}
+    assert f"Skipped 1 invalid rows in file {first}" in capsys.readouterr().out
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_source_algorithm_selection(tmp_path, workers):
+    files = []
+    for index in range(2):
+        csv_file = tmp_path / f"{index}.csv"
+        csv_file.write_text(
+            "host;labels\n" + "".join(f"host{i};n:{index}\n" for i in range(20))
+        )
+        files.append(str(csv_file))
+    source = lpds_csv().source_algorithm(
+        csv_files=files,
+        workers=workers,
+        hosts=["host1", "host12", "other"],
+        host_regex="host1",
+    )
+    assert source == {"host1": {"n": "1"}, "host12": {"n": "1"}}
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8; py-indent-offset: 4 -*-
+
+# SPDX-FileCopyrightText: © 2023 PL Automation Monitoring GmbH <pl@automation-monitoring.com>
+# SPDX-License-Identifier: GPL-3.0-or-later
+# This file is part of the Checkmk Labelpicker project (https://labelpicker.mk)
+
+import json
+import os
+
+import pytest
+
+from labelpicker.labelpicker_base import host_shard, shard_path
+from labelpicker.ds_plugins.lpds_hwswtree import lpds_hwswtree
+
+MAPPING = [{"labelname": "os", "tree": ["Software", "Operating System", "Name"]}]
+
+
+def inventory_tree(os_name):
+    return {
+        "Attributes": {},
+        "Table": {},
+        "Nodes": {
+            "software": {
+                "Attributes": {},
+                "Table": {},
+                "Nodes": {
+                    "os": {
+                        "Attributes": {"Pairs": {"name": os_name}},
+                        "Table": {},
+                        "Nodes": {},
+                    }
+                },
+            }
+        },
+    }
+
+
+@pytest.fixture
+def inventory_dir(tmp_path):
+    directory = tmp_path / "inventory"
+    directory.mkdir()
+    for i in range(8):
+        (directory / f"h{i}").write_text(repr(inventory_tree(f"os{i}")))
+    # ignored: hidden files and .gz copies
+    (directory / "h0.gz").write_text("not parsed")
+    (directory / ".h1").write_text("not parsed")
+    return directory
+
+
+def read(inventory_dir, cache_file, **selection):
+    return dict(
+        lpds_hwswtree().stream_algorithm(
+            label_prefix="hw",
+            inventory_dir=str(inventory_dir),
+            mapping=MAPPING,
+            parse_cache=True,
+            parse_cache_file=str(cache_file),
+            **selection,
+        )
+    )
+
+
+def cached_hosts(cache_file):
+    with open(cache_file) as f:
+        return sorted(os.path.basename(path) for path in json.load(f)["entries"])
+
+
+def test_stream(inventory_dir, tmp_path):
+    labels = read(inventory_dir, tmp_path / "cache.json")
+    assert labels == {f"h{i}": {"hw/os": f"os{i}"} for i in range(8)}
+
+
+def test_parse_cache_prune(inventory_dir, tmp_path):
+    """Entries of deleted files are dropped, unless only selected hosts were read"""
+    cache_file = tmp_path / "cache.json"
+    read(inventory_dir, cache_file)
+    for i in (5, 6, 7):
+        os.unlink(inventory_dir / f"h{i}")
+    read(inventory_dir, cache_file, hosts=["h1"])
+    read(inventory_dir, cache_file, host_regex="h[12]")
+    assert cached_hosts(cache_file) == [f"h{i}" for i in range(8)]
+    read(inventory_dir, cache_file)
+    assert cached_hosts(cache_file) == [f"h{i}" for i in range(5)]
+
+
+def test_parse_cache_prune_shards(inventory_dir, tmp_path):
+    """A shard reads all files of the shard, so it prunes its own cache"""
+    cache_file = tmp_path / "cache.json"
+    for index in (1, 2):
+        read(inventory_dir, cache_file, shard=(index, 2))
+    for i in (5, 6, 7):
+        os.unlink(inventory_dir / f"h{i}")
+    for index in (1, 2):
+        labels = read(inventory_dir, cache_file, shard=(index, 2))
+        expected = [f"h{i}" for i in range(5) if host_shard(f"h{i}", 2) == index]
+        assert sorted(labels) == expected
+        assert cached_hosts(shard_path(str(cache_file), (index, 2))) == expected